@@ -1,25 +1,94 @@
+import logging
+import signal
+import threading
+import uuid
 from urllib.parse import unquote
 
 from flask import Flask
 from flask import Response
 from flask import abort
+from flask import g
+from flask import json
 from flask import jsonify
 from flask import render_template
 from flask import request
 from flask import send_file
+from flask import stream_with_context
+from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.exceptions import BadRequest
 
 from bootstrapper.lib import archive_utils
 from bootstrapper.lib import bootstrapper_utils
 from bootstrapper.lib import cache_utils
+from bootstrapper.lib import coalesce_utils
+from bootstrapper.lib import config_utils
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import log_utils
+from bootstrapper.lib import metrics_utils
+from bootstrapper.lib import profile_utils
+from bootstrapper.lib import repository_utils
+from bootstrapper.lib import store_utils
+from bootstrapper.lib import template_utils
 from bootstrapper.lib.db import db_session
 from bootstrapper.lib.db import init_db
+from bootstrapper.lib.exceptions import InvalidConfigurationError
+from bootstrapper.lib.exceptions import QueueFullError
 from bootstrapper.lib.exceptions import RequiredParametersError
 from bootstrapper.lib.exceptions import TemplateNotFoundError
 
 app = Flask(__name__)
-defaults = bootstrapper_utils.load_defaults()
 config = bootstrapper_utils.load_config()
+# the batch workers render with the same jinja environment, so it must be set up before they are forked
+app.jinja_env.bytecode_cache = template_utils.init_bytecode_cache(config.get('bytecode_cache_directory', None))
+# fork the batch workers before any other thread is started
+bootstrapper_utils.init_batch_pool(app, config.get('batch_workers', 0))
+log_utils.init_logging(config.get('logging', dict()))
+log = logging.getLogger(__name__)
+# set once the template library has been imported and loaded, see init_application
+_ready = threading.Event()
+cache_utils.init_cache(config.get('cache', dict()))
+store_utils.init_store(config.get('archive_store', dict()))
+job_utils.init_jobs(config.get('jobs', dict()))
+
+
+def _handle_sighup(signum, frame):
+    # only mark the configuration files as stale, they are parsed again on next use outside of the signal handler
+    config_utils.configuration.invalidate()
+    config_utils.defaults.invalidate()
+
+
+def _get_disk_usage():
+    usage = store_utils.get_usage()
+    return {('store',): usage['store_bytes'], ('workspace',): usage['build_bytes']}
+
+
+def _get_job_depth():
+    stats = job_utils.get_stats()
+    return {('queued',): stats['queued'], ('running',): stats['running']}
+
+
+def _get_template_cache_requests():
+    stats = template_utils.get_stats()
+    return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+
+# these are only gathered when the metrics are scraped, so they cost nothing in between
+metrics_utils.Gauge('bootstrapper_archive_store_bytes', 'Disk space used by the archive store and build workspaces',
+                    ['area'], callback=_get_disk_usage)
+metrics_utils.Gauge('bootstrapper_jobs', 'Archive build jobs waiting for or being worked on by a worker', ['state'],
+                    callback=_get_job_depth)
+metrics_utils.Gauge('bootstrapper_coalesced_builds_in_flight', 'Builds that identical requests may wait on',
+                    callback=lambda: coalesce_utils.get_stats()['in_flight'])
+metrics_utils.Counter('bootstrapper_coalesced_requests_total', 'Requests that shared the result of an identical build',
+                      callback=lambda: coalesce_utils.get_stats()['coalesced'])
+metrics_utils.Counter('bootstrapper_template_cache_requests_total', 'Compiled template cache lookups by result',
+                      ['result'], callback=_get_template_cache_requests)
+
+try:
+    signal.signal(signal.SIGHUP, _handle_sighup)
+except (AttributeError, ValueError):
+    # no SIGHUP on this platform or we are not being imported from the main thread
+    pass
 
 
 @app.route('/')
@@ -37,7 +106,8 @@ def api():
     Simple api to return the swagger json
     :return: json file
     """
-    return send_file('templates/bootstrapper.swagger.json')
+    # the swagger file never changes at runtime, let send_file answer conditional requests from it's mtime
+    return send_file('templates/bootstrapper.swagger.json', conditional=True)
 
 
 @app.route('/get/<key>', methods=['GET'])
@@ -72,6 +142,75 @@ def set_object():
     return jsonify(key=key, success=True)
 
 
+def _build_files(posted_json):
+    """
+    Renders all files of a bootstrap package from the posted json, aborting the request on invalid input
+    :param posted_json: params supplied via JSON POST
+    :return: dict of files suitable for the archive_utils functions
+    """
+    try:
+        base_config = bootstrapper_utils.build_base_configs(posted_json)
+
+    except RequiredParametersError:
+        abort(400, 'Invalid input parameters')
+    except TemplateNotFoundError as tnfe:
+        log.error('Could not load templates: %s', tnfe)
+        abort(500, 'Could not load template!')
+
+    # if desired deployment type is openstack, then add the heat templates and whatnot
+    if 'deployment_type' in posted_json and posted_json['deployment_type'] == 'openstack':
+        try:
+            base_config = bootstrapper_utils.build_openstack_heat(base_config, posted_json, archive=True)
+        except RequiredParametersError:
+            abort(400, 'Could not parse JSON data')
+
+    if 'hostname' not in posted_json:
+        abort(400, 'No hostname found in posted data')
+
+    return base_config
+
+
+def _is_weak_etag(archive_type):
+    # only zip archives built with zipfile are byte for byte reproducible, anything else gets a weak ETag
+    archive_mode = bootstrapper_utils.load_config().get('archive_mode', 'memory')
+    return archive_type == 'iso' or archive_mode == 'filesystem'
+
+
+def _build_stored_archive(base_config, hostname, archive_type, content_key):
+    """
+    Returns the archive from the archive store, building and storing it first if needed
+    :param base_config: dict of files as returned from _build_files
+    :param hostname: hostname of the device, used to name the archive
+    :param archive_type: zip or iso
+    :param content_key: content key of the archive, see archive_utils.get_content_key
+    :return: open file object of the archive or None if it could not be created
+    """
+    archive = store_utils.get(content_key, archive_type)
+    if archive is not None:
+        return archive
+
+    config = bootstrapper_utils.load_config()
+    # user has specified they want an ISO built
+    if archive_type == 'iso':
+        archive = archive_utils.create_iso(base_config, hostname, mode=config.get('iso_mode', 'memory'))
+    else:
+        # no ISO required, just make a zip
+        archive = archive_utils.create_archive(base_config, hostname, mode=config.get('archive_mode', 'memory'))
+
+    if archive is None:
+        return None
+
+    return store_utils.put(content_key, archive_type, archive)
+
+
+def _send_archive(archive, hostname, archive_type, content_key):
+    mime_type = 'application/iso-image' if archive_type == 'iso' else 'application/zip'
+    file_name = '%s.%s' % (hostname, archive_type)
+    r = send_file(archive, mimetype=mime_type, attachment_filename=file_name, add_etags=False)
+    r.set_etag(content_key, weak=_is_weak_etag(archive_type))
+    return r
+
+
 @app.route('/generate_bootstrap_package', methods=['POST'])
 def generate_bootstrap_package():
     """
@@ -87,62 +226,278 @@ def generate_bootstrap_package():
 
     try:
         posted_json = request.get_json(force=True)
-        base_config = bootstrapper_utils.build_base_configs(posted_json)
+    except BadRequest:
+        abort(400, 'Invalid input parameters')
 
-    except (BadRequest, RequiredParametersError):
+    # if the user supplies an 'archive_type' parameter we can return either a ZIP or ISO
+    archive_type = 'iso' if posted_json.get('archive_type', 'zip') == 'iso' else 'zip'
+    config = bootstrapper_utils.load_config()
+
+    if archive_type == 'zip' and config.get('archive_mode', 'memory') == 'stream':
+        base_config = _build_files(posted_json)
+        return Response(stream_with_context(archive_utils.stream_archive(base_config)), mimetype='application/zip')
+
+    def build():
+        base_config = _build_files(posted_json)
+        # identical rendered files always produce the same archive, so the content key doubles as the ETag
+        content_key = archive_utils.get_content_key(base_config, archive_type)
+        if request.if_none_match.contains_weak(content_key):
+            return content_key, base_config, None
+
+        archive = _build_stored_archive(base_config, posted_json['hostname'], archive_type, content_key)
+        if archive is None:
+            abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+
+        return content_key, base_config, archive
+
+    # identical requests that arrive while the first one is still being built wait for it instead of building
+    # again. The If-None-Match header is part of the key, as it decides if an archive is built at all
+    flight_key = coalesce_utils.get_key(posted_json, archive_type, request.headers.get('If-None-Match', None))
+    (content_key, base_config, archive), shared = coalesce_utils.do(flight_key, build)
+
+    if archive is None:
+        r = Response(status=304)
+        r.set_etag(content_key, weak=_is_weak_etag(archive_type))
+        return r
+
+    if shared:
+        # the open archive belongs to the request that built it, get our own copy from the store
+        archive = _build_stored_archive(base_config, posted_json['hostname'], archive_type, content_key)
+        if archive is None:
+            abort(500, 'Could not create archive! Check bootstrapper logs for more information')
+
+    return _send_archive(archive, posted_json['hostname'], archive_type, content_key)
+
+
+def _build_job_archive(base_config, hostname, archive_type, content_key):
+    archive = _build_stored_archive(base_config, hostname, archive_type, content_key)
+    if archive is None:
+        raise OSError('Could not create archive! Check bootstrapper logs for more information')
+
+    # the result is retrieved from the archive store, which any worker process can read
+    archive.close()
+    return dict(hostname=hostname, archive_type=archive_type, content_key=content_key)
+
+
+@app.route('/submit_bootstrap_job', methods=['POST'])
+def submit_bootstrap_job():
+    """
+    Asynchronous version of generate_bootstrap_package that accepts the same params. The files are rendered right
+    away, so invalid input is still reported immediately, but the archive is built by a bounded pool of job workers.
+    Poll the status_url until the job is complete, then download the archive from the result_url
+
+    :return: json with 'success', 'job_id', 'status_url', and 'result_url' keys. 503 with a Retry-After header when
+    the job queue is full
+    """
+    try:
+        posted_json = request.get_json(force=True)
+    except BadRequest:
         abort(400, 'Invalid input parameters')
+
+    base_config = _build_files(posted_json)
+    archive_type = 'iso' if posted_json.get('archive_type', 'zip') == 'iso' else 'zip'
+    content_key = archive_utils.get_content_key(base_config, archive_type)
+
+    try:
+        job = job_utils.submit(_build_job_archive, base_config, posted_json['hostname'], archive_type, content_key)
+    except QueueFullError:
+        r = jsonify(message="Too many jobs are queued, try again later", success=False, status_code=503)
+        r.status_code = 503
+        r.headers['Retry-After'] = str(bootstrapper_utils.load_config().get('jobs', dict()).get('retry_after', 5))
+        return r
+
+    r = jsonify(success=True, job_id=job.job_id, status_url='/job_status/%s' % job.job_id,
+                result_url='/job_result/%s' % job.job_id, status_code=202)
+    r.status_code = 202
+    return r
+
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Reports the status of a job. Pass a 'wait' query string parameter to long-poll for up to that many seconds until
+    the job is finished
+    :param job_id: id of the job as returned from submit_bootstrap_job
+    :return: json with 'success' and 'job' keys
+    """
+    job = job_utils.get(job_id)
+    if job is None:
+        r = jsonify(message="Job not found", success=False, status_code=404)
+        r.status_code = 404
+        return r
+
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = 0
+
+    max_wait = bootstrapper_utils.load_config().get('jobs', dict()).get('max_wait', 30)
+    if wait > 0:
+        job.wait(min(wait, max_wait))
+
+    return jsonify(success=True, job=job.to_dict(), status_code=200)
+
+
+@app.route('/job_result/<job_id>', methods=['GET'])
+def job_result(job_id):
+    """
+    Downloads the archive built by a complete job
+    :param job_id: id of the job as returned from submit_bootstrap_job
+    :return: binary package or json with 'success' and 'message' keys if the result is not available
+    """
+    job = job_utils.get(job_id)
+    if job is None:
+        r = jsonify(message="Job not found", success=False, status_code=404)
+        r.status_code = 404
+        return r
+
+    if job.status != 'complete':
+        # conflict until the job is complete, and for good if it failed
+        r = jsonify(message="Job is %s" % job.status, success=False, status_code=409)
+        r.status_code = 409
+        return r
+
+    archive = store_utils.get(job.result['content_key'], job.result['archive_type'])
+    if archive is None:
+        r = jsonify(message="Job result has expired", success=False, status_code=410)
+        r.status_code = 410
+        return r
+
+    return _send_archive(archive, job.result['hostname'], job.result['archive_type'], job.result['content_key'])
+
+
+@app.route('/job_stats', methods=['GET'])
+def job_stats():
+    """
+    Returns the queue depth, in flight count, and counters of the job pool
+    :return: json with 'success' and 'stats' keys
+    """
+    return jsonify(success=True, stats=job_utils.get_stats(), status_code=200)
+
+
+@app.route('/render_bootstrap_package', methods=['POST'])
+def render_bootstrap_package():
+    """
+    Renders the same files as generate_bootstrap_package but returns them as json instead of building an archive.
+    Nothing is written to the filesystem or the cache, which makes this the cheapest way to generate user-data for
+    cloud targets. Accepts the same params as generate_bootstrap_package, except archive_type
+
+    :return: json with 'success' and 'files' keys, 'files' maps each file name to a dict containing the
+    'archive_path' and the rendered 'contents'
+    """
+    try:
+        posted_json = request.get_json(force=True)
+        files = bootstrapper_utils.build_base_configs(posted_json, cache=False)
+
+        if posted_json.get('deployment_type', '') == 'openstack':
+            # the other files can only be referenced by name, as they do not have a url to retrieve them from
+            files = bootstrapper_utils.build_openstack_heat(files, posted_json, archive=True, cache=False)
+
+    except (BadRequest, RequiredParametersError):
+        r = jsonify(message="Not all required keys are present", success=False, status_code=400)
+        r.status_code = 400
+        return r
     except TemplateNotFoundError:
-        print('Could not load tempaltes!')
-        abort(500, 'Could not load template!')
+        r = jsonify(message="Could not load template", success=False, status_code=500)
+        r.status_code = 500
+        return r
 
-    # if desired deployment type is openstack, then add the heat templates and whatnot
-    if 'deployment_type' in posted_json and posted_json['deployment_type'] == 'openstack':
-        try:
-            base_config = bootstrapper_utils.build_openstack_heat(base_config, posted_json, archive=True)
-        except RequiredParametersError:
-            abort(400, 'Could not parse JSON data')
+    return jsonify(success=True, files=files, status_code=200)
 
-    if 'hostname' not in posted_json:
-        abort(400, 'No hostname found in posted data')
 
-    # if the user supplies an 'archive_type' parameter we can return either a ZIP or ISO
+@app.route('/generate_bootstrap_batch', methods=['POST'])
+def generate_bootstrap_batch():
+    """
+    Builds bootstrap packages for many devices in one call. You must post the following params:
+    devices: list of dicts containing the device specific variables, each must include at least a hostname
+    archive_type: zip, iso
+    response_type: archive (default) to return a single archive with one directory per hostname, or manifest to
+    return json with a download key for each device archive
+
+    All other posted variables are shared between all devices and can be overridden by each device. Devices that
+    fail validation are reported individually in the manifest and do not fail the whole batch
+
+    :return: binary package with one directory per device or json manifest
+    """
+    try:
+        posted_json = request.get_json(force=True)
+    except BadRequest:
+        abort(400, 'Invalid input parameters')
+
+    devices = posted_json.pop('devices', None)
+    if type(devices) is not list or len(devices) == 0 or not all(type(d) is dict for d in devices):
+        r = jsonify(message="A non-empty list of devices is required", success=False, status_code=400)
+        r.status_code = 400
+        return r
+
     archive_type = posted_json.get('archive_type', 'zip')
+    response_type = posted_json.pop('response_type', 'archive')
+    config = bootstrapper_utils.load_config()
+
+    if response_type != 'manifest' and archive_type != 'iso' and config.get('archive_mode', 'memory') == 'stream':
+        # render and stream each device as it's ready instead of waiting for the whole batch
+        results = bootstrapper_utils.iter_batch_configs(posted_json, devices)
+        return Response(stream_with_context(archive_utils.stream_archive(bootstrapper_utils.iter_batch_files(results))),
+                        mimetype='application/zip')
+
+    results = bootstrapper_utils.build_batch_configs(posted_json, devices)
+
+    if response_type == 'manifest':
+        for result in results:
+            files = result.pop('files', None)
+            if files is None:
+                continue
+
+            # build an archive per device and store it in the cache for later retrieval
+            hostname = result['hostname']
+            if archive_type == 'iso':
+                archive = archive_utils.create_iso(files, hostname, mode=config.get('iso_mode', 'memory'))
+            else:
+                archive = archive_utils.create_archive(files, hostname, mode=config.get('archive_mode', 'memory'))
+
+            if archive is None:
+                result['success'] = False
+                result['message'] = 'Could not create archive'
+                continue
+
+            result['key'] = cache_utils.set(archive_utils.read_archive(archive))
+            result['url'] = config['base_url'] + '/get/' + result['key']
+
+        return jsonify(success=True, devices=results, status_code=200)
+
+    batch_files = dict(bootstrapper_utils.iter_batch_files(results))
+    if len(batch_files) == 1:
+        r = jsonify(message="Could not build any devices", success=False, devices=results, status_code=400)
+        r.status_code = 400
+        return r
 
-    # user has specified they want an ISO built
+    batch_name = 'batch-%s' % uuid.uuid4()
     if archive_type == 'iso':
-        archive = archive_utils.create_iso(base_config, posted_json['hostname'])
+        archive = archive_utils.create_iso(batch_files, batch_name, mode=config.get('iso_mode', 'memory'))
         mime_type = 'application/iso-image'
-
+        file_name = '%s.iso' % batch_name
     else:
-        # no ISO required, just make a zip
-        archive = archive_utils.create_archive(base_config, posted_json['hostname'])
+        archive = archive_utils.create_archive(batch_files, batch_name, mode=config.get('archive_mode', 'memory'))
         mime_type = 'application/zip'
+        file_name = '%s.zip' % batch_name
 
-    print("archive path is: %s" % archive)
     if archive is None:
         abort(500, 'Could not create archive! Check bootstrapper logs for more information')
 
-    return send_file(archive, mimetype=mime_type)
+    return send_file(archive, mimetype=mime_type, attachment_filename=file_name)
 
 
 @app.route('/get_bootstrap_variables', methods=['POST'])
 def get_bootstrap_variables():
-    print('Compiling variables required in payload to generate a valid bootstrap archive')
     posted_json = request.get_json(force=True)
     vs = bootstrapper_utils.get_bootstrap_variables(posted_json)
     payload = dict()
 
     if 'bootstrap_template' in posted_json and posted_json['bootstrap_template'] is not None:
-        print('Using bootstrap %s' % posted_json['bootstrap_template'])
         payload['bootstrap_template'] = posted_json['bootstrap_template']
-    else:
-        print('No bootstrap file requested')
 
     if 'init_cfg_template' in posted_json and posted_json['init_cfg_template'] is not None:
-        print('Setting init_cfg_name')
         payload['init_cfg_template'] = posted_json['init_cfg_template']
-    else:
-        print('No init_cfg file requested')
 
     if 'format' in posted_json and posted_json['format'] == 'aframe':
         for v in vs:
@@ -169,13 +524,11 @@ def import_template():
         template = unquote(encoded_template)
 
     except KeyError:
-        print("Not all required keys are present!")
         r = jsonify(message="Not all required keys for add template are present", success=False, status_code=400)
         r.status_code = 400
         return r
-    print('Importing template with name: %s' % name)
-    print('Importing template with description: %s' % description)
-    print(template)
+    log.info('Importing template %s', name, extra=dict(description=description, template_type=template_type))
+    log.debug('Importing template %s', name, extra=dict(template=template))
     if bootstrapper_utils.import_template(template, name, description, template_type):
         return jsonify(success=True, message='Imported Template Successfully', status_code=200)
     else:
@@ -195,7 +548,6 @@ def delete_template():
     try:
         name = posted_json['template_name']
     except KeyError:
-        print("Not all required keys are present!")
         r = jsonify(message="Not all required keys for add template are present", success=False, status_code=400)
         r.status_code = 400
         return r
@@ -208,31 +560,197 @@ def delete_template():
         return r
 
 
+def _get_page_args():
+    """
+    Parses the optional 'name_prefix', 'offset', and 'limit' query string parameters of the list endpoints
+    :return: dict of keyword arguments for bootstrapper_utils.list_templates
+    """
+    offset = int(request.args.get('offset', 0))
+    limit = request.args.get('limit', None)
+    if limit is not None:
+        limit = int(limit)
+
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError('offset and limit must not be negative')
+
+    return dict(name_prefix=request.args.get('name_prefix', None), offset=offset, limit=limit)
+
+
+def _snapshot_response(snapshot, key, build, mimetype):
+    """
+    Returns a response that only depends on the contents of the template snapshot. The ETag and Last-Modified
+    headers are derived from the snapshot version, so clients that already have the current version get a 304 and
+    everyone else gets a body that is only serialized once per version
+    :param snapshot: current TemplateSnapshot
+    :param key: hashable key identifying the response within the snapshot
+    :param build: function without arguments that builds the response body
+    :param mimetype: mimetype of the response body
+    :return: Response
+    """
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(snapshot.etag)
+    else:
+        not_modified = request.if_modified_since is not None and snapshot.last_modified <= request.if_modified_since
+
+    if not_modified:
+        r = Response(status=304)
+    else:
+        r = Response(snapshot.get_response(key, build), mimetype=mimetype)
+
+    r.set_etag(snapshot.etag)
+    r.last_modified = snapshot.last_modified
+    # clients may keep the response but must check with us before using it again
+    r.cache_control.no_cache = True
+    return r
+
+
+def _list_templates(template_type):
+    try:
+        page_args = _get_page_args()
+    except ValueError:
+        r = jsonify(message="offset and limit must be positive integers", success=False, status_code=400)
+        r.status_code = 400
+        return r
+
+    snapshot = repository_utils.get_snapshot()
+
+    def build():
+        ts, total = bootstrapper_utils.list_templates(template_type, snapshot=snapshot, **page_args)
+        return json.dumps(dict(success=True, templates=ts, total=total, offset=page_args['offset'],
+                               limit=page_args['limit'], status_code=200))
+
+    key = ('list_templates', template_type, page_args['name_prefix'], page_args['offset'], page_args['limit'])
+    return _snapshot_response(snapshot, key, build, 'application/json')
+
+
 @app.route('/list_templates', methods=['GET'])
 def list_templates():
-    ts = bootstrapper_utils.list_bootstrap_templates()
-    return jsonify(success=True, templates=ts, status_code=200)
+    """
+    Lists the available templates, bootstrap templates unless another 'type' is given. Supports the optional
+    'name_prefix', 'offset', and 'limit' query string parameters to filter and page through large template libraries
+    :return: json with 'success', 'templates', and 'total' keys
+    """
+    return _list_templates(request.args.get('type', 'bootstrap'))
 
 
-@app.route('/get_template', methods=['POST'])
+@app.route('/get_template', methods=['GET', 'POST'])
 def get_template():
-    posted_json = request.get_json(force=True)
-    try:
-        name = posted_json['template_name']
-    except KeyError:
-        print("Not all required keys are present!")
+    """
+    Returns the text of a template. The template_name is given either in the posted json or as a query string
+    parameter. Supports conditional requests, see _snapshot_response
+    :return: template text
+    """
+    if request.method == 'GET':
+        name = request.args.get('template_name', None)
+    else:
+        posted_json = request.get_json(force=True)
+        name = posted_json.get('template_name', None)
+
+    if name is None:
         r = jsonify(message="Not all required keys for add template are present", success=False, status_code=400)
         r.status_code = 400
         return r
 
-    ts = bootstrapper_utils.get_template(name)
-    return Response(ts, mimetype='text/plain')
+    snapshot = repository_utils.get_snapshot()
+
+    def build():
+        return bootstrapper_utils.get_template(name, snapshot=snapshot) or ''
+
+    return _snapshot_response(snapshot, ('get_template', name), build, 'text/plain')
 
 
 @app.route('/list_init_cfg_templates', methods=['GET'])
 def list_init_cfg_templates():
-    ts = bootstrapper_utils.list_init_cfg_templates()
-    return jsonify(success=True, templates=ts, status_code=200)
+    """
+    Lists the available init-cfg templates, supports the same query string parameters as list_templates
+    :return: json with 'success', 'templates', and 'total' keys
+    """
+    return _list_templates('init-cfg')
+
+
+@app.route('/template_cache_stats', methods=['GET'])
+def template_cache_stats():
+    """
+    Returns the hit / miss counters of the compiled template cache
+    :return: json with 'success' and 'stats' keys
+    """
+    return jsonify(success=True, stats=template_utils.get_stats(), status_code=200)
+
+
+@app.route('/archive_store_stats', methods=['GET'])
+def archive_store_stats():
+    """
+    Returns the current disk usage of the archive store
+    :return: json with 'success' and 'stats' keys
+    """
+    return jsonify(success=True, stats=store_utils.get_usage(), status_code=200)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Returns the metrics of this worker process in the prometheus text format
+    :return: text/plain response
+    """
+    return Response(metrics_utils.expose(), content_type=metrics_utils.content_type)
+
+
+@app.route('/reload_config', methods=['POST'])
+def reload_config():
+    """
+    Parses the configuration.yaml and defaults.yaml files again. Changes to the files are also picked up
+    automatically, this is only needed to force a reload, for example after restoring a file with an older timestamp
+    :return: json with 'success' and 'message' keys
+    """
+    try:
+        config_utils.reload()
+        log_utils.init_logging(bootstrapper_utils.load_config().get('logging', dict()))
+    except InvalidConfigurationError:
+        r = jsonify(message="Could not load configuration", success=False, status_code=500)
+        r.status_code = 500
+        return r
+
+    return jsonify(message="Configuration reloaded", success=True, status_code=200)
+
+
+@app.before_request
+def start_profile():
+    # the header is checked first, so requests that do not ask for a profile never load the configuration here
+    token = request.headers.get(profile_utils.request_header, None) or request.args.get(profile_utils.request_arg,
+                                                                                          None)
+    if token is None:
+        return
+
+    profile_config = bootstrapper_utils.load_config().get('profiling', dict())
+    g.profiler = profile_utils.start(profile_config, token)
+    g.profile_config = profile_config
+
+
+def _stop_profile():
+    """
+    Stops profiling the current request if it is being profiled
+    :return: id of the written profile or None
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+
+    return profile_utils.stop(profiler, g.profile_config)
+
+
+@app.after_request
+def finish_profile(response):
+    profile_id = _stop_profile()
+    if profile_id is not None:
+        response.headers[profile_utils.response_header] = profile_id
+
+    return response
+
+
+@app.teardown_request
+def abort_profile(exception=None):
+    # after_request is skipped when the view raised, make sure the profiler is never left running
+    _stop_profile()
 
 
 @app.teardown_appcontext
@@ -240,10 +758,50 @@ def shutdown_session(exception=None):
     db_session.remove()
 
 
-@app.before_first_request
 def init_application():
-    init_db()
-    bootstrapper_utils.import_templates()
+    """
+    Creates the template table, imports all default and imported templates, and loads the template snapshot
+    :return: None
+    """
+    try:
+        init_db()
+        bootstrapper_utils.import_templates()
+        repository_utils.load_snapshot()
+        _ready.set()
+    finally:
+        # do not keep a connection open for the thread that ran the import
+        db_session.remove()
+
+
+@app.before_first_request
+def ensure_application():
+    # only does any work when the warm up at boot has failed
+    if not _ready.is_set():
+        init_application()
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness check for load balancers and orchestrators. Reports if the template library has been imported and
+    loaded, and the service is ready to build bootstrap packages without delay
+    :return: json with 'success' and 'ready' keys, the status code is 503 until the service is ready
+    """
+    if not _ready.is_set():
+        r = jsonify(message="Service is starting", success=False, ready=False, status_code=503)
+        r.status_code = 503
+        r.headers['Retry-After'] = '1'
+        return r
+
+    templates = len(repository_utils.get_snapshot().records)
+    return jsonify(success=True, ready=True, templates=templates, status_code=200)
+
+
+# warm up at boot instead of on the first request, so the first client is never kept waiting on the import
+try:
+    init_application()
+except SQLAlchemyError as sqe:
+    log.error('Could not initialize application, will try again on the first request: %s', sqe)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,73 @@
+import hashlib
+import io
 import logging
 import os
-from shutil import make_archive
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+from werkzeug.utils import secure_filename
 
 from . import cache_utils
+from . import metrics_utils
+
+try:
+    import pycdlib
+except ImportError:
+    # ISO images will be built with mkisofs instead
+    pycdlib = None
 
-_archive_dir = '/tmp/bootstrapper/archives'
+# each filesystem or mkisofs build gets it's own private workspace below this directory, preferably in RAM
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    _workspace_dir = '/dev/shm/bootstrapper/workspaces'
+else:
+    _workspace_dir = '/tmp/bootstrapper/workspaces'
+# in memory archives larger than this will be spooled to a temporary file instead
+_max_memory_archive_size = 8 * 1024 * 1024
+# streamed archives are sent in chunks of roughly this size
+_stream_chunk_size = 64 * 1024
+# all zip entries get the same timestamp so identical files always produce an identical archive
+_zip_date_time = (1980, 1, 1, 0, 0, 0)
 log = logging.getLogger(__name__)
 
 
-def _create_archive_directory(files, archive_name):
+def _get_file_contents(file_entry):
+    """
+    Returns the contents of a single entry of the files dict
+    :param file_entry: dict containing either a 'contents' key or a 'key' to retrieve the contents from the cache
+    :return: contents of the file
+    """
+    if 'contents' in file_entry:
+        return file_entry['contents']
+
+    contents = cache_utils.get(file_entry['key'])
+    if contents is None:
+        raise ValueError('Could not retrieve file contents from the cache with key %s' % file_entry['key'])
+
+    return contents
+
+
+def get_workspace_dir():
+    """
+    :return: directory the private workspace of each filesystem or mkisofs build is created in
+    """
+    return _workspace_dir
+
+
+def _create_workspace():
+    """
+    Creates a private directory for a single build, so concurrent builds for the same hostname can never see each
+    others files or any left over from an earlier build. The caller must remove it once the build is done
+    :return: path to the new workspace
+    """
+    if not os.path.exists(_workspace_dir):
+        os.makedirs(_workspace_dir, exist_ok=True)
+
+    return tempfile.mkdtemp(dir=_workspace_dir)
+
+
+def _create_archive_directory(files, archive_name, workspace):
     """
     Creates a directory structure from the given files dict
     :param files: A dict of files with the following structure:
@@ -20,12 +79,17 @@ def _create_archive_directory(files, archive_name):
                     }
                 }
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
-    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
+    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'.
+    An optional 'file_name' may be given to use a different filename than the key, this allows the same filename to
+    appear in several directories of the same archive. The contents may also be given directly in a 'contents' key
+    instead of a cache 'key'
     :param archive_name: the name of the archive to create
+    :param workspace: private build directory as returned from _create_workspace
     :return: path to the newly created directory or None on error
     """
-    log.info('_create_archive_directory with name %s' % archive_name)
-    archive_file_path = os.path.join(_archive_dir, archive_name)
+    log.debug('_create_archive_directory with name %s', archive_name)
+    # archive_name is usually the hostname supplied by the user, make sure it stays inside the workspace
+    archive_file_path = os.path.join(workspace, secure_filename(archive_name) or 'archive')
 
     try:
         if not os.path.exists(archive_file_path):
@@ -35,8 +99,8 @@ def _create_archive_directory(files, archive_name):
         return None
 
     for f in files:
-        archive_file_dir = os.path.join(_archive_dir, archive_name, files[f]['archive_path'])
-        archive_file = os.path.abspath(os.path.join(archive_file_dir, f))
+        archive_file_dir = os.path.join(archive_file_path, files[f]['archive_path'])
+        archive_file = os.path.abspath(os.path.join(archive_file_dir, files[f].get('file_name', f)))
 
         try:
             if not os.path.exists(archive_file_dir):
@@ -46,16 +110,179 @@ def _create_archive_directory(files, archive_name):
             return None
         try:
             with open(os.path.abspath(archive_file), 'w') as tmp_file:
-                contents = cache_utils.get(files[f]['key'])
+                contents = _get_file_contents(files[f])
                 tmp_file.write(contents)
-        except OSError:
+        except (OSError, ValueError):
             log.error('Could not write archive file into directory')
             return None
 
     return archive_file_path
 
 
-def create_archive(files, archive_name):
+def _iter_zip_entries(files):
+    """
+    Yields each entry of the files dict as it should be written to a zip archive. An explicit entry is added for each
+    directory the first time it is seen to match the layout produced by make_archive
+    :param files: A dict of files, see create_archive for the structure. This may also be an iterable of
+    (FILENAME, file dict) tuples to build the files lazily while the archive is written
+    :return: generator of (archive name, contents) tuples, contents is None for directory entries
+    """
+    if isinstance(files, dict):
+        # sort the entries so the same files always produce the same archive
+        files = sorted(files.items(),
+                       key=lambda i: os.path.normpath(os.path.join(i[1]['archive_path'], i[1].get('file_name', i[0]))))
+
+    added_dirs = set()
+    for f, file_entry in files:
+        archive_file_dir = os.path.normpath(file_entry['archive_path'])
+        if archive_file_dir != '.':
+            parts = archive_file_dir.split('/')
+            for i in range(len(parts)):
+                d = '/'.join(parts[:i + 1]) + '/'
+                if d not in added_dirs:
+                    added_dirs.add(d)
+                    yield d, None
+
+        file_name = file_entry.get('file_name', f)
+        yield os.path.normpath(os.path.join(archive_file_dir, file_name)), _get_file_contents(file_entry)
+
+
+def _zip_info(name):
+    """
+    Returns a ZipInfo with a fixed timestamp and fixed permissions so archives are reproducible
+    :param name: name of the entry in the archive, directories must end with a '/'
+    :return: zipfile.ZipInfo
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=_zip_date_time)
+    zinfo.create_system = 3
+    if name.endswith('/'):
+        zinfo.external_attr = (0o40755 << 16) | 0x10
+    else:
+        zinfo.external_attr = 0o100644 << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+    return zinfo
+
+
+def get_content_key(files, archive_type):
+    """
+    Returns a hash of the archive type and the names and contents of all the given files. Identical files will always
+    result in the same key, so this can be used to look up a previously built archive. The contents of each file are
+    resolved in place, so the archive can be built afterwards without fetching them from the cache again
+    :param files: A dict of files, see create_archive for the structure
+    :param archive_type: zip or iso
+    :return: hex digest
+    """
+    with metrics_utils.stage_seconds.time('content_key'):
+        return _get_content_key(files, archive_type)
+
+
+def _get_content_key(files, archive_type):
+    content_hash = hashlib.sha256(archive_type.encode('utf-8'))
+    for f in files:
+        files[f]['contents'] = _get_file_contents(files[f])
+
+    for name, contents in _iter_zip_entries(files):
+        content_hash.update(b'\0' + name.encode('utf-8') + b'\0')
+        if contents is not None:
+            if isinstance(contents, str):
+                contents = contents.encode('utf-8')
+
+            content_hash.update(str(len(contents)).encode('utf-8') + b'\0' + contents)
+
+    return content_hash.hexdigest()
+
+
+def _create_archive_in_memory(files):
+    """
+    Creates a zip file of the desired files directly in a memory buffer without touching the archive directory
+    :param files: A dict of files, see create_archive for the structure
+    :return: file-like object positioned at the start of the zip data or None on error
+    """
+    archive = tempfile.SpooledTemporaryFile(max_size=_max_memory_archive_size)
+    try:
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, contents in _iter_zip_entries(files):
+                zf.writestr(_zip_info(name), '' if contents is None else contents)
+
+    except (ValueError, OSError, zipfile.BadZipfile) as e:
+        log.error('Could not make in memory zip archive: %s', e)
+        archive.close()
+        return None
+
+    archive.seek(0)
+    return archive
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Unseekable file-like object that collects everything written to it until it is drained. Because it cannot seek,
+    zipfile will write a data descriptor after each entry instead of going back to patch up the local file header
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = list()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self.size += len(b)
+        return len(b)
+
+    def drain(self):
+        """
+        :return: bytes written since the last drain
+        """
+        data = b''.join(self._chunks)
+        self._chunks = list()
+        self.size = 0
+        return data
+
+
+def stream_archive(files):
+    """
+    Creates a zip file of the desired files as a stream of chunks. Each entry is compressed and yielded as soon as
+    it is written, so the first bytes can be sent to the client before the whole archive is built and memory use
+    stays flat regardless of the archive size
+    :param files: A dict of files, see create_archive for the structure. This may also be an iterable of
+    (FILENAME, file dict) tuples to build the files lazily while the archive is streamed
+    :return: generator of bytes
+    """
+    metrics_utils.archives.inc('zip', 'stream')
+    stream = _StreamBuffer()
+    try:
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, contents in _iter_zip_entries(files):
+                if contents is None:
+                    zf.writestr(_zip_info(name), '')
+                    continue
+
+                if isinstance(contents, str):
+                    contents = contents.encode('utf-8')
+
+                with zf.open(_zip_info(name), 'w') as entry:
+                    for i in range(0, len(contents), _stream_chunk_size):
+                        entry.write(contents[i:i + _stream_chunk_size])
+                        if stream.size >= _stream_chunk_size:
+                            yield stream.drain()
+
+                # send each finished entry straight away
+                yield stream.drain()
+
+    except (ValueError, OSError, zipfile.BadZipfile) as e:
+        # the response has already begun, all we can do is log and cut the stream short
+        log.error('Could not stream zip archive: %s', e)
+        raise
+
+    # whatever is left over along with the central directory
+    yield stream.drain()
+
+
+def create_archive(files, archive_name, mode='memory'):
     """
     Creates a zip file of the desired files with the desired structure.
     :param files: A dict of files with the following structure:
@@ -67,27 +294,101 @@ def create_archive(files, archive_name):
                     }
                 }
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
-    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
+    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'.
+    An optional 'file_name' may be given to use a different filename than the key, this allows the same filename to
+    appear in several directories of the same archive. The contents may also be given directly in a 'contents' key
+    instead of a cache 'key'
     :param archive_name: the name of the archive to create
-    :return: path to the newly created archive or None on error
+    :param mode: 'memory' to build the zip in a memory buffer or 'filesystem' to build it on disk in a private
+    workspace
+    :return: file-like object or None on error
     """
+    with metrics_utils.builds_in_flight.track('zip'), metrics_utils.stage_seconds.time('zip'):
+        archive = _create_archive(files, archive_name, mode)
+
+    if archive is not None:
+        metrics_utils.archives.inc('zip', mode)
+    return archive
 
-    archive_file_path = _create_archive_directory(files, archive_name)
-    if archive_file_path is None:
-        log.error('Could not create archive directory structure')
+
+def _create_archive(files, archive_name, mode):
+    if mode != 'filesystem':
+        log.debug('Creating in memory archive for %s', archive_name)
+        return _create_archive_in_memory(files)
+
+    try:
+        workspace = _create_workspace()
+    except OSError:
+        log.error('Could not create build workspace')
         return None
 
-    try: 
-        zip_file = make_archive(archive_file_path, 'zip', root_dir=archive_file_path)
-    except [ValueError, OSError]:
+    try:
+        archive_file_path = _create_archive_directory(files, archive_name, workspace)
+        if archive_file_path is None:
+            log.error('Could not create archive directory structure')
+            return None
+
+        zip_file = shutil.make_archive(archive_file_path, 'zip', root_dir=archive_file_path)
+        log.debug('Created %s successfully', zip_file)
+        # the open file can still be read once the workspace is removed
+        return open(zip_file, 'rb')
+
+    except (ValueError, OSError):
         log.error('Could not make zip archive')
         return None
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
 
-    log.info('Created %s successfully' % zip_file)
-    return zip_file
 
+def _create_iso_in_memory(files):
+    """
+    Creates an ISO image with Joliet and Rock Ridge extensions directly in a memory buffer using pycdlib
+    :param files: A dict of files, see create_iso for the structure
+    :return: file-like object positioned at the start of the ISO image or None on error
+    """
+    iso = pycdlib.PyCdlib()
+    # interchange level 4 allows lowercase, multi-dot and long file names like the mkisofs flags below
+    iso.new(interchange_level=4, joliet=3, rock_ridge='1.09', vol_ident='bootstrap', app_ident_str='bootstrap')
+
+    archive = tempfile.SpooledTemporaryFile(max_size=_max_memory_archive_size)
+    try:
+        added_dirs = set()
+        for f in files:
+            archive_file_dir = os.path.normpath(files[f]['archive_path'])
+            if archive_file_dir == '.':
+                iso_dir = ''
+            else:
+                iso_dir = '/' + archive_file_dir
+                # create each parent directory in turn, pycdlib will not create them for us
+                parts = archive_file_dir.split('/')
+                for i in range(len(parts)):
+                    d = '/' + '/'.join(parts[:i + 1])
+                    if d not in added_dirs:
+                        iso.add_directory(d, rr_name=parts[i], joliet_path=d)
+                        added_dirs.add(d)
+
+            contents = _get_file_contents(files[f])
+            if isinstance(contents, str):
+                contents = contents.encode('utf-8')
+
+            file_name = files[f].get('file_name', f)
+            iso_path = iso_dir + '/' + file_name
+            iso.add_fp(io.BytesIO(contents), len(contents), iso_path, rr_name=file_name, joliet_path=iso_path)
+
+        iso.write_fp(archive)
 
-def create_iso(files, archive_name):
+    except (pycdlib.pycdlibexception.PyCdlibException, ValueError, OSError) as e:
+        log.error('Could not make in memory ISO image: %s', e)
+        archive.close()
+        return None
+    finally:
+        iso.close()
+
+    archive.seek(0)
+    return archive
+
+
+def create_iso(files, archive_name, mode='memory'):
     """
     Creates an ISO image of the desired files with the desired structure.
     :param files: A dict of files with the following structure:
@@ -99,30 +400,75 @@ def create_iso(files, archive_name):
                     }
                 }
     Each key of the dict is a filename that will be created. The contents of the file will be retrieved from the cache
-    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'
+    system using the cache_utils library. The file will be placed in the relative path given by the 'archive_path'.
+    An optional 'file_name' may be given to use a different filename than the key, this allows the same filename to
+    appear in several directories of the same archive. The contents may also be given directly in a 'contents' key
+    instead of a cache 'key'
     :param archive_name: the name of the archive to create
-    :return: path to the newly created ISO image or None on error
+    :param mode: 'memory' to build the image in process with pycdlib or 'mkisofs' to build it on disk in a private
+    workspace with the external mkisofs binary. 'mkisofs' is always used if pycdlib is not installed
+    :return: file-like object or None on error
     """
+    with metrics_utils.builds_in_flight.track('iso'), metrics_utils.stage_seconds.time('iso'):
+        archive = _create_iso(files, archive_name, mode)
+
+    if archive is not None:
+        metrics_utils.archives.inc('iso', mode)
+    return archive
+
 
-    archive_file_path = _create_archive_directory(files, archive_name)
-    if archive_file_path is None:
-        log.error('Could not create archive directory structure')
+def _create_iso(files, archive_name, mode):
+    if mode != 'mkisofs':
+        if pycdlib is not None:
+            log.debug('Creating in memory ISO image for %s', archive_name)
+            return _create_iso_in_memory(files)
+
+        log.warning('pycdlib is not installed, falling back to mkisofs')
+
+    try:
+        workspace = _create_workspace()
+    except OSError:
+        log.error('Could not create build workspace')
         return None
 
-    iso_image = archive_file_path + '.iso'
     try:
-        rv = os.system(
-            'mkisofs -J -R -v -V bootstrap -A bootstrap -ldots -l '
-            '-allow-lowercase -allow-multidot -o %s %s' % (iso_image, archive_file_path)
-        )
+        archive_file_path = _create_archive_directory(files, archive_name, workspace)
+        if archive_file_path is None:
+            log.error('Could not create archive directory structure')
+            return None
+
+        iso_image = archive_file_path + '.iso'
+        rv = subprocess.call([
+            'mkisofs', '-J', '-R', '-v', '-V', 'bootstrap', '-A', 'bootstrap', '-ldots', '-l',
+            '-allow-lowercase', '-allow-multidot', '-o', iso_image, archive_file_path
+        ])
         if rv != 0:
-            print("Cold not make ISO Image!")
+            log.error('Could not make ISO Image! mkisofs returned %s', rv)
             return None
 
-    except [ValueError, OSError]:
-        print("Could not make ISO Image")
+        log.debug('Created %s successfully', iso_image)
+        # the open file can still be read once the workspace is removed
+        return open(iso_image, 'rb')
+
+    except (ValueError, OSError):
         log.error('Could not make ISO image')
         return None
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def read_archive(archive):
+    """
+    Returns the contents of an archive as returned from create_archive or create_iso regardless of the mode it was
+    created with
+    :param archive: file-like object or path to the archive on disk
+    :return: bytes of the archive
+    """
+    if isinstance(archive, str):
+        with open(archive, 'rb') as archive_file:
+            return archive_file.read()
 
-    log.info('Created %s successfully' % iso_image)
-    return iso_image
+    try:
+        return archive.read()
+    finally:
+        archive.close()
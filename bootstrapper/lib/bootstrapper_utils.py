@@ -1,25 +1,43 @@
+import atexit
+import json
+import logging
+import multiprocessing
 import os
 
-import jinja2
-import yaml
 from flask import Flask
-from flask import g
 from flask import render_template
-from flask import render_template_string
-from jinja2 import meta
-from jinja2 import TemplateSyntaxError
+from jinja2 import TemplateError
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.utils import secure_filename
 
 from bootstrapper.lib import cache_utils
+from bootstrapper.lib import config_utils
+from bootstrapper.lib import log_utils
+from bootstrapper.lib import metrics_utils
 from bootstrapper.lib import openstack_utils
+from bootstrapper.lib import repository_utils
+from bootstrapper.lib import template_utils
 from bootstrapper.lib.db import db_session
+from bootstrapper.lib.db import engine
 from bootstrapper.lib.db_models import Template
 from bootstrapper.lib.exceptions import RequiredParametersError
 from bootstrapper.lib.exceptions import TemplateNotFoundError
-from bootstrapper.lib.exceptions import InvalidConfigurationError
+
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# listed first in the bootstrap templates to allow building a package without a bootstrap.xml
+_no_bootstrap_template = repository_utils.TemplateRecord(name='None', description='No Bootstrap.xml Required',
+                                                         type='bootstrap', variables=frozenset())
+
+# flask app used by batch worker processes, set just before the worker pool is forked
+_batch_app = None
+# pool of batch worker processes, the number of workers in it, and the pid of the process that forked it
+_batch_pool = None
+_batch_workers = 0
+_batch_pool_pid = None
+
 
 def load_defaults():
     """
@@ -31,48 +49,20 @@ def load_defaults():
     The UI or client interface can always overwrite these!  To always enforce options just hard code them into
     the template directly
 
-    :return: dict containing default values
-    """
-    with app.app_context():
-        defaults = getattr(g, 'bootstrap_config', None)
-        if defaults is None:
-            try:
-                with open(os.path.join(app.root_path, '../conf/defaults.yaml')) as config_file:
-                    defaults = yaml.load(config_file.read())
-            except yaml.scanner.ScannerError:
-                print("Could not load defaults!")
-                raise InvalidConfigurationError('Could not parse defaults configuration file')
+    The file is only parsed again when it changes on disk, see config_utils.ConfigFile
 
-        return defaults
+    :return: read only dict containing default values
+    """
+    return config_utils.defaults.get()
 
 
 def load_config():
     """
-    Loads and caches the bootstrapper service configuration from the bootstrapper/conf/configuration.yaml file
-    :return: dict containing all configuration options
+    Loads and caches the bootstrapper service configuration from the bootstrapper/conf/configuration.yaml file. The
+    file is only parsed again when it changes on disk, see config_utils.ConfigFile
+    :return: read only dict containing all configuration options
     """
-    with app.app_context():
-        config = getattr(g, 'bootstrap_config', None)
-        if config is None:
-            try:
-                with open(os.path.join(app.root_path, '../conf/configuration.yaml')) as config_file:
-                    config = yaml.load(config_file.read())
-
-                if type(config) is not dict:
-                    print("Unknown config object from configuration.yaml")
-                    config = dict()
-
-                if 'template_locations' not in config:
-                    print("invalid configuration found, hmmm...")
-                    config['template_locations'] = list()
-
-                g.bootstrap_config = config
-
-            except yaml.scanner.ScannerError:
-                print("Could not load configuration files!")
-                raise InvalidConfigurationError('Could not load configuration')
-
-        return config
+    return config_utils.configuration.get()
 
 
 def import_template(template, template_name, description, template_type='bootstrap'):
@@ -89,19 +79,20 @@ def import_template(template, template_name, description, template_type='bootstr
         t = Template.query.filter(Template.name == template_name).first()
 
         if t is None:
-            print('Adding new record to db')
+            log.info('Adding template %s', template_name, extra=dict(template_type=template_type))
             unescaped_template = unescape(template)
             t = Template(name=template_name, description=description, template=unescaped_template, type=template_type)
             db_session.add(t)
             db_session.commit()
+            template_utils.invalidate(template_name)
+            repository_utils.load_snapshot()
 
         else:
-            print('template exists in db')
+            log.info('Template %s already exists', template_name)
 
         return True
     except SQLAlchemyError as sqe:
-        print('Could not import file')
-        print(str(sqe))
+        log.error('Could not import template %s: %s', template_name, sqe)
         return False
 
 
@@ -117,41 +108,57 @@ def delete_template(file_name):
         if t is not None:
             db_session.delete(t)
             db_session.commit()
+            template_utils.invalidate(file_name)
+            repository_utils.load_snapshot()
 
         return True
     except SQLAlchemyError as sqe:
-        print('Could not delete template!')
-        print(sqe)
+        log.error('Could not delete template %s: %s', file_name, sqe)
         return False
 
 
+def list_templates(template_type='bootstrap', name_prefix=None, offset=0, limit=None, snapshot=None):
+    """
+    List one page of the templates of the given type. Only the template metadata is used, the template text is never
+    loaded
+
+    :param template_type: bootstrap or init-cfg
+    :param name_prefix: only list templates whose name starts with this string
+    :param offset: number of matching templates to skip
+    :param limit: maximum number of templates to return or None to return all
+    :param snapshot: TemplateSnapshot to list the templates of, defaults to the current snapshot
+    :return: tuple of (list of template dict objects, total number of matching templates)
+    """
+    if snapshot is None:
+        snapshot = repository_utils.get_snapshot()
+
+    records = snapshot.list_by_type(template_type)
+    if template_type == 'bootstrap':
+        records = (_no_bootstrap_template,) + records
+
+    if name_prefix:
+        records = [t for t in records if t.name.startswith(name_prefix)]
+
+    end = None if limit is None else offset + limit
+    page = list()
+    # only build the response objects for the requested page
+    for t in records[offset:end]:
+        db_template = dict()
+        db_template['name'] = t.name
+        db_template['description'] = t.description
+        db_template['type'] = t.type
+        page.append(db_template)
+
+    return page, len(records)
+
+
 def list_bootstrap_templates():
     """
     List all templates that are available for use by bootstrapper utility
 
     :return: list of template dict objects
     """
-    all_templates = list()
-    default_template = dict()
-    default_template['name'] = 'None'
-    default_template['description'] = 'No Bootstrap.xml Required'
-    default_template['type'] = 'bootstrap'
-    all_templates.append(default_template)
-
-    try:
-        db_templates = Template.query.filter(Template.type == 'bootstrap')
-        for t in db_templates:
-            db_template = dict()
-            db_template['name'] = t.name
-            db_template['description'] = t.description
-            db_template['type'] = t.type
-            all_templates.append(db_template)
-
-    except SQLAlchemyError as sqe:
-        print('Could not list bootstrap templates')
-        print(sqe)
-    finally:
-        return all_templates
+    return list_templates('bootstrap')[0]
 
 
 def list_init_cfg_templates():
@@ -160,90 +167,61 @@ def list_init_cfg_templates():
 
     :return: list of template dict objects
     """
-    all_templates = list()
+    return list_templates('init-cfg')[0]
 
-    try:
-        db_templates = Template.query.filter(Template.type == 'init-cfg')
-        for t in db_templates:
-            db_template = dict()
-            db_template['name'] = t.name
-            db_template['description'] = t.description
-            db_template['type'] = t.type
-            all_templates.append(db_template)
 
-    except SQLAlchemyError as sqe:
-        print('Could not list init-cfg templates')
-        print(sqe)
-    finally:
-        return all_templates
-
-
-def get_template(template_name):
+def get_template(template_name, snapshot=None):
     """
     :param template_name: Name of the template to return
+    :param snapshot: TemplateSnapshot to get the template from, defaults to the current snapshot
     :return: string containing the template content or None
     """
-    try:
-        t = Template.query.filter(Template.name == template_name).first()
+    if snapshot is None:
+        snapshot = repository_utils.get_snapshot()
 
-        if t is None:
-            print('Could not load template %s' % template_name)
-            return None
+    with metrics_utils.stage_seconds.time('template_fetch'):
+        t = snapshot.get_text(template_name)
 
-        return t.template
-    except SQLAlchemyError as sqe:
-        print('Could not get template')
-        print(sqe)
+    if t is None:
+        log.warning('Could not load template %s', template_name)
         return None
 
+    return t
+
 
-def get_required_vars_from_template(template_name):
+def get_required_vars_from_template(template_name, snapshot=None):
     """
-    Parse the template and return a list of all the variables defined therein
-    template path is usually something like 'templates/panos/bootstrap.xml'
-    :param template_name: relative path to the application root to a jinja2 template
+    Return a set of all the variables defined in the template. The variables are parsed once when the template is
+    imported and stored alongside it in the template table
+    :param template_name: name of the template in the template table
+    :param snapshot: TemplateSnapshot to get the template from, defaults to the current snapshot
     :return: set of variable named defined in the template
     """
+    if snapshot is None:
+        snapshot = repository_utils.get_snapshot()
 
-    template_variables = set()
+    t = snapshot.get(template_name)
 
-    try:
-        t = Template.query.filter(Template.name == template_name).first()
+    if t is None:
+        log.warning('Could not load template %s', template_name)
+        return set()
 
-        if t is None:
-            print('Could not load template %s' % template_name)
-            return template_variables
-
-        # get the jinja environment to use it's parse function
-        env = jinja2.Environment()
-        # parse returns an AST that can be send to the meta module
-        ast = env.parse(t.template)
-        # return a set of all variable defined in the template
-        template_variables = meta.find_undeclared_variables(ast)
-
-    except TemplateSyntaxError as tse:
-        print('Could not parse template')
-        print(tse)
-    except SQLAlchemyError as sqe:
-        print('Could not load template variables')
-        print(sqe)
-    finally:
-        return template_variables
+    return set(t.variables)
 
 
-def verify_data(template, available_vars):
+def verify_data(template, available_vars, snapshot=None):
     """
     Verify all the required variables have been posted from the user
-    :param template: jinja2 template to check
+    :param template: name of the jinja2 template to check
     :param available_vars: dict of all available variables from the posted data and also the defaults
+    :param snapshot: TemplateSnapshot to get the template from, defaults to the current snapshot
     :return:
     """
-    vs = get_required_vars_from_template(template)
-    print(vs)
+    vs = get_required_vars_from_template(template, snapshot)
+    log.debug('Checking variables of template %s', template, extra=dict(variables=sorted(vs)))
     for r in vs:
-        print("checking var: %s" % r)
         if r not in available_vars:
-            print("template variable %s is not defined!!" % r)
+            log.info('Template variable %s of template %s is not defined', r, template)
             return False
 
     return True
@@ -256,29 +234,30 @@ def get_bootstrap_variables(requested_templates):
     :return: list of variables defined in all requested templates
     """
 
-    print('getting bootstrap variables')
     available_variables = list()
+    snapshot = repository_utils.get_snapshot()
 
     init_cfg_name = requested_templates.get('init_cfg_template', 'init-cfg-static.txt')
     bootstrap_name = requested_templates.get('bootstrap_template', None)
 
-    init_cfg_vars = get_required_vars_from_template(init_cfg_name)
+    init_cfg_vars = get_required_vars_from_template(init_cfg_name, snapshot)
     for i in init_cfg_vars:
         available_variables.append(i)
 
     if bootstrap_name != "None" or bootstrap_name is not None:
-        vs = get_required_vars_from_template(bootstrap_name)
+        vs = get_required_vars_from_template(bootstrap_name, snapshot)
         for b in vs:
             available_variables.append(b)
 
     return available_variables
 
 
-def generate_boostrap_config_with_defaults(defaults, configuration_parameters):
+def generate_boostrap_config_with_defaults(defaults, configuration_parameters, snapshot=None):
     """
     Generates a dict of context parameters pre-seeded with defaults form the conf/defaults.yaml file
     :param defaults:  object from the defaults.yaml file
     :param configuration_parameters: params supplied to the bootstrapper service via JSON POST
+    :param snapshot: TemplateSnapshot to get the template from, defaults to the current snapshot
     :return: dict of context parameters
     """
 
@@ -293,7 +272,7 @@ def generate_boostrap_config_with_defaults(defaults, configuration_parameters):
     if 'bootstrap' in defaults:
         bootstrap_config.update(defaults['bootstrap'])
 
-    defined_vars = get_required_vars_from_template(bootstrap_template_name)
+    defined_vars = get_required_vars_from_template(bootstrap_template_name, snapshot)
     # push all the required keys - should have already been validated
     for k in defined_vars:
         bootstrap_config[k] = configuration_parameters.get(k, None)
@@ -301,172 +280,189 @@ def generate_boostrap_config_with_defaults(defaults, configuration_parameters):
     return bootstrap_config
 
 
-def import_templates():
+def _get_startup_templates(config):
     """
-    Ensures all default and imported templates exist in the template table
-    :return: None
+    Lists all default and imported templates that should exist in the template table
+    :param config: bootstrapper service configuration
+    :return: list of (name, description, path, type) tuples
     """
-    loaded_config = load_config()
-
-    config = load_config()
-    print('config is %s' % config)
     default_bootstrap_name = config.get('default_template', 'Default')
-
-    default = Template.query.filter(Template.name == default_bootstrap_name).first()
-    if default is None:
-        print('Importing default bootstrap.xml files')
-        default_file_path = os.path.abspath(os.path.join(app.root_path, '..', 'templates/panos/bootstrap.xml'))
-        try:
-            with open(default_file_path, 'r') as dfpf:
-                t = Template(name=default_bootstrap_name,
-                             description='Default Bootstrap template',
-                             template=dfpf.read(),
-                             type='bootstrap')
-
-            db_session.add(t)
-            db_session.commit()
-        except OSError:
-            print('Could not open file for importing')
-
-    print('Importing init-cfg-static')
-    init_cfg_static = Template.query.filter(Template.name == 'init-cfg-static.txt').first()
-    if init_cfg_static is None:
-        print('Importing default init-cfg-static')
-        ics_file_path = os.path.abspath(os.path.join(app.root_path, '..', 'templates/panos/init-cfg-static.txt'))
-        try:
-            print(
-                'opening file init-cfg-static'
-            )
-            with open(ics_file_path, 'r') as icsf:
-                i = Template(name='init-cfg-static.txt',
-                             description='Init-Cfg with static management IP addresses',
-                             template=icsf.read(),
-                             type='init-cfg')
-
-                print('add to db')
-                db_session.add(i)
-                print('commit to db')
-                db_session.commit()
-        except OSError:
-            print('Could not open file for importing')
-
-    init_cfg_dhcp = Template.query.filter(Template.name == 'Default Init-Cfg DHCP').first()
-    if init_cfg_dhcp is None:
-        print('Importing default init-cfg-dhcp')
-        icd_file_path = os.path.abspath(os.path.join(app.root_path, '..', 'templates/panos/init-cfg-dhcp.txt'))
-        try:
-            with open(icd_file_path, 'r') as icdf:
-                i = Template(name='Default Init-Cfg DHCP',
-                             description='Init-Cfg with DHCP Assigned IP addresses',
-                             template=icdf.read(),
-                             type='init-cfg')
-
-                db_session.add(i)
-                db_session.commit()
-        except OSError:
-            print('Could not open file for importing')
-
-    rel_import_directory = loaded_config.get('template_import_directory', 'templates/import/bootstrap')
+    panos_directory = os.path.abspath(os.path.join(app.root_path, '..', 'templates/panos'))
+
+    startup_templates = [
+        (default_bootstrap_name, 'Default Bootstrap template', os.path.join(panos_directory, 'bootstrap.xml'),
+         'bootstrap'),
+        ('init-cfg-static.txt', 'Init-Cfg with static management IP addresses',
+         os.path.join(panos_directory, 'init-cfg-static.txt'), 'init-cfg'),
+        ('Default Init-Cfg DHCP', 'Init-Cfg with DHCP Assigned IP addresses',
+         os.path.join(panos_directory, 'init-cfg-dhcp.txt'), 'init-cfg')
+    ]
+
+    rel_import_directory = config.get('template_import_directory', 'templates/import/bootstrap')
     import_directory = os.path.abspath(os.path.join(app.root_path, '..', rel_import_directory))
-    all_imported_files = os.listdir(import_directory)
+    try:
+        all_imported_files = sorted(os.listdir(import_directory))
+    except OSError:
+        log.warning('Could not list template import directory %s', import_directory)
+        all_imported_files = list()
 
-    print('Importing bootstrap templates')
     for it in all_imported_files:
-        t = Template.query.filter(Template.name == it).first()
-        if t is None:
-            print('this template does not exist %s' % it)
+        startup_templates.append((it, 'Imported Template', os.path.join(import_directory, it), 'bootstrap'))
+
+    # FIXME - add init-cfg importing as well (as soon as we need it)
+    return startup_templates
+
+
+def import_templates():
+    """
+    Ensures all default and imported templates exist in the template table. The existing template names are fetched
+    in a single query and all missing templates are added in a single transaction
+    :return: number of templates added
+    """
+    config = load_config()
+
+    try:
+        existing = set(name for (name,) in db_session.query(Template.name))
+        missing = list()
+        for name, description, path, template_type in _get_startup_templates(config):
+            if name in existing:
+                continue
+
             try:
-                with open(os.path.join(import_directory, it), 'r') as tf:
-                    t = Template(name=it,
-                                 description="Imported Template",
-                                 template=tf.read(),
-                                 type='bootstrap')
-                    db_session.add(t)
-                    db_session.commit()
+                with open(path, 'r') as tf:
+                    missing.append(Template(name=name, description=description, template=tf.read(),
+                                            type=template_type))
             except OSError:
-                print('Could not import bootstrap template!')
+                log.error('Could not open file for importing: %s', path)
+                continue
 
-    # FIXME - add init-cfg importing as well (as soon as we need it)
+            existing.add(name)
 
+        if missing:
+            log.info('Importing %d templates', len(missing))
+            db_session.add_all(missing)
+            db_session.commit()
+
+        return len(missing)
+
+    except SQLAlchemyError as sqe:
+        log.error('Could not import templates: %s', sqe)
+        db_session.rollback()
+        return 0
+
+
+def _add_rendered_file(base_config, file_name, contents, archive_path, cache):
+    """
+    Adds a rendered file to the base_config dict
+    :param base_config: dict of files to add the file to
+    :param file_name: name of the file
+    :param contents: rendered contents of the file
+    :param archive_path: directory of the file in the archive
+    :param cache: also store the contents in the cache and add the 'key' and 'url' to retrieve it
+    :return: None
+    """
+    base_config[file_name] = dict()
+    base_config[file_name]['archive_path'] = archive_path
+    base_config[file_name]['contents'] = contents
+    if cache:
+        get_file_url(base_config[file_name])
+
+
+def get_file_url(file_entry):
+    """
+    Returns the url to retrieve a rendered file from the /get endpoint. The file contents are only stored in the cache
+    the first time a url is asked for, the archive functions take the contents straight from the file entry
+    :param file_entry: dict as added to the base_config by build_base_configs
+    :return: url of the file
+    """
+    if 'url' not in file_entry:
+        key = cache_utils.set(file_entry['contents'])
+        file_entry['key'] = key
+        file_entry['url'] = load_config()["base_url"] + '/get/' + key
+
+    return file_entry['url']
 
-def build_base_configs(configuration_parameters):
+
+def build_base_configs(configuration_parameters, cache=False, snapshot=None):
     """
-    Takes a dict of parameters and builds the base configurations
+    Takes a dict of parameters and builds the base configurations. The rendered contents of each file are kept in
+    memory, so they can be handed straight to the archive functions
     :param configuration_parameters:  Simple dict of parameters
+    :param cache: also store each rendered file in the cache up front, see get_file_url
+    :param snapshot: TemplateSnapshot to get the templates from, defaults to the current snapshot. All templates of
+    a package come from the same snapshot
     :return: dict containing 'bootstrap.xml', 'authcodes', and 'init-cfg-static.txt' keys
     """
 
     config = load_config()
     defaults = load_defaults()
-    print('WTF')
+    if snapshot is None:
+        snapshot = repository_utils.get_snapshot()
+
     # first check for a custom init-cfg file passed in as a parameter
     if 'init_cfg_template' in configuration_parameters:
-        print('found a valid init_cfg_template')
         init_cfg_name = configuration_parameters['init_cfg_template']
-        init_cfg_template = get_template(init_cfg_name)
-        print(init_cfg_template)
+        init_cfg_template = get_template(init_cfg_name, snapshot)
         if init_cfg_template is None:
-            init_cfg_template = get_template(config.get('default_init_cfg'), 'init-cfg-static.txt')
+            init_cfg_name = config.get('default_init_cfg', 'init-cfg-static.txt')
+            init_cfg_template = get_template(init_cfg_name, snapshot)
     else:
-        print('using default init-cfg')
         init_cfg_name = config.get('default_init_cfg', 'init-cfg-static.txt')
-        init_cfg_template = get_template(init_cfg_name)
+        init_cfg_template = get_template(init_cfg_name, snapshot)
 
+    log.debug('Using init-cfg template %s', init_cfg_name, extra=dict(template=init_cfg_template))
     if init_cfg_template is None:
-        print('init-cfg-template template was None')
         raise TemplateNotFoundError('Could not load %s' % init_cfg_name)
 
-    print('getting required_keys')
-    common_required_keys = get_required_vars_from_template(init_cfg_name)
+    common_required_keys = get_required_vars_from_template(init_cfg_name, snapshot)
 
     if not common_required_keys.issubset(configuration_parameters):
-        print("Not all required keys are present for build_base_config!!")
+        log.info('Not all required variables are present for %s', init_cfg_name,
+                 extra=dict(missing=sorted(common_required_keys.difference(configuration_parameters))))
         raise RequiredParametersError("Not all required keys are present for build_base_config!!")
 
-    init_cfg_contents = render_template_string(init_cfg_template, **configuration_parameters)
-    init_cfg_key = cache_utils.set(init_cfg_contents)
+    with metrics_utils.stage_seconds.time('render_init_cfg'):
+        init_cfg_contents = template_utils.render_template_string(init_cfg_name, init_cfg_template,
+                                                                  **configuration_parameters)
 
     base_config = dict()
-    base_config['init-cfg.txt'] = dict()
-    base_config['init-cfg.txt']['key'] = init_cfg_key
-    base_config['init-cfg.txt']['archive_path'] = 'config'
-    base_config['init-cfg.txt']['url'] = config["base_url"] + '/get/' + init_cfg_key
+    _add_rendered_file(base_config, 'init-cfg.txt', init_cfg_contents, 'config', cache)
 
     if 'auth_key' in configuration_parameters:
-        authcode = render_template('panos/authcodes', **configuration_parameters)
-        authcode_key = cache_utils.set(authcode)
-        base_config['authcodes'] = dict()
-        base_config['authcodes']['key'] = authcode_key
-        base_config['authcodes']['archive_path'] = 'license'
-        base_config['authcodes']['url'] = config["base_url"] + '/get/' + init_cfg_key
+        with metrics_utils.stage_seconds.time('render_authcodes'):
+            authcode = render_template('panos/authcodes', **configuration_parameters)
+        _add_rendered_file(base_config, 'authcodes', authcode, 'license', cache)
 
     if 'bootstrap_template' in configuration_parameters and configuration_parameters['bootstrap_template'] != 'None':
-        print('Using a bootstrap_template here')
-        print(configuration_parameters['bootstrap_template'])
         bootstrap_template_name = configuration_parameters['bootstrap_template']
-        print(bootstrap_template_name)
-        bootstrap_config = generate_boostrap_config_with_defaults(defaults, configuration_parameters)
+        bootstrap_config = generate_boostrap_config_with_defaults(defaults, configuration_parameters, snapshot)
 
-        bootstrap_template = get_template(bootstrap_template_name)
+        bootstrap_template = get_template(bootstrap_template_name, snapshot)
         if bootstrap_template is None:
             raise TemplateNotFoundError('Could not load bootstrap template!')
 
-        print("checking bootstrap required_variables")
-        if not verify_data(bootstrap_template, bootstrap_config):
+        log.debug('Using bootstrap template %s', bootstrap_template_name, extra=dict(template=bootstrap_template))
+        if not verify_data(bootstrap_template_name, bootstrap_config, snapshot):
             raise RequiredParametersError('Not all required keys for bootstrap.xml are present')
 
-        bootstrap_xml = render_template_string(bootstrap_template, **bootstrap_config)
-        bs_key = cache_utils.set(bootstrap_xml)
-
-        base_config['bootstrap.xml'] = dict()
-        base_config['bootstrap.xml']['key'] = bs_key
-        base_config['bootstrap.xml']['archive_path'] = 'config'
-        base_config['bootstrap.xml']['url'] = config["base_url"] + '/get/' + bs_key
+        with metrics_utils.stage_seconds.time('render_bootstrap_xml'):
+            bootstrap_xml = template_utils.render_template_string(bootstrap_template_name, bootstrap_template,
+                                                                  **bootstrap_config)
+        _add_rendered_file(base_config, 'bootstrap.xml', bootstrap_xml, 'config', cache)
 
     return base_config
 
 
-def build_openstack_heat(base_config, posted_json, archive=False):
+def build_openstack_heat(base_config, posted_json, archive=False, cache=False):
+    """
+    Adds the openstack heat templates to the base_config
+    :param base_config: dict of files as returned from build_base_configs
+    :param posted_json: params supplied to the bootstrapper service via JSON POST
+    :param archive: reference the other files by their name in the archive instead of their url. Without an archive,
+    the other files are stored in the cache so they can be retrieved from their url
+    :param cache: also store the rendered heat templates in the cache up front, see get_file_url
+    :return: base_config
+    """
     defaults = load_defaults()
 
     if not openstack_utils.verify_data(posted_json):
@@ -480,25 +476,176 @@ def build_openstack_heat(base_config, posted_json, archive=False):
         openstack_config['bootstrap_xml'] = 'bootstrap.xml'
         openstack_config['authcodes'] = 'authcodes'
     else:
-        openstack_config['init_cfg'] = base_config['init-cfg-static.txt']['url']
-        openstack_config['bootstrap_xml'] = base_config['bootstrap.xml']['url']
-        openstack_config['authcodes'] = base_config['authcodes']['url']
+        openstack_config['init_cfg'] = get_file_url(base_config['init-cfg.txt'])
+        if 'bootstrap.xml' in base_config:
+            openstack_config['bootstrap_xml'] = get_file_url(base_config['bootstrap.xml'])
+        if 'authcodes' in base_config:
+            openstack_config['authcodes'] = get_file_url(base_config['authcodes'])
 
-    heat_env = render_template('openstack/heat-environment.yaml', **openstack_config)
-    heat = render_template('openstack/heat.yaml', **base_config)
+    with metrics_utils.stage_seconds.time('render_heat'):
+        heat_env = render_template('openstack/heat-environment.yaml', **openstack_config)
+        heat = render_template('openstack/heat.yaml', **base_config)
 
-    he_key = cache_utils.set(heat_env)
-    h_key = cache_utils.set(heat)
+    _add_rendered_file(base_config, 'heat-environment.yaml', heat_env, '.', cache)
+    _add_rendered_file(base_config, 'heat-template.yaml', heat, '.', cache)
 
-    base_config['heat-environment.yaml'] = dict()
-    base_config['heat-environment.yaml']['key'] = he_key
-    base_config['heat-environment.yaml']['archive_path'] = '.'
+    return base_config
 
-    base_config['heat-template.yaml'] = dict()
-    base_config['heat-template.yaml']['key'] = h_key
-    base_config['heat-template.yaml']['archive_path'] = '.'
 
-    return base_config
+def _init_batch_worker():
+    """
+    Initializes a forked batch worker process. Each worker needs it's own app context and logging, and must not reuse
+    any database connections inherited from the parent process
+    :return: None
+    """
+    db_session.registry.clear()
+    engine.dispose()
+    log_utils.init_worker_logging(load_config().get('logging', dict()))
+    _batch_app.app_context().push()
+
+
+def init_batch_pool(flask_app, workers):
+    """
+    Forks the worker processes used to render batch requests. This must be called at boot before any threads are
+    started, a process forked later may inherit a lock that another thread holds at that moment and hang forever. The
+    workers are kept for the lifetime of the process
+    :param flask_app: flask app the workers render templates with
+    :param workers: number of worker processes, 0 will use one per cpu core
+    :return: None
+    """
+    global _batch_app, _batch_pool, _batch_workers, _batch_pool_pid
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        # batches are rendered in the request thread instead
+        return
+
+    _batch_app = flask_app
+    # do not hand any open connections over to the forked workers
+    db_session.remove()
+    _batch_pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_batch_worker)
+    _batch_workers = workers
+    _batch_pool_pid = os.getpid()
+    atexit.register(_batch_pool.terminate)
+
+
+def _get_hostname_error(hostname):
+    """
+    Hostnames of a batch are used as directory names in the archive, so only plain names that cannot escape their
+    directory are allowed
+    :param hostname: hostname of the device as posted
+    :return: error message or None if the hostname is valid
+    """
+    if hostname is None:
+        return 'No hostname found in device data'
+
+    if not isinstance(hostname, str) or not hostname or secure_filename(hostname) != hostname:
+        return 'Invalid hostname, only letters, numbers, dots, dashes, and underscores are allowed'
+
+    return None
+
+
+def _build_batch_device(configuration_parameters):
+    """
+    Builds the configuration files for a single device of a batch. Errors are returned instead of raised so one
+    invalid device will not fail the whole batch
+    :param configuration_parameters: dict of shared parameters merged with the device specific overrides
+    :return: dict containing 'hostname', 'success', and either 'files' or 'message' keys
+    """
+    hostname = configuration_parameters.get('hostname', None)
+    try:
+        hostname_error = _get_hostname_error(hostname)
+        if hostname_error is not None:
+            raise RequiredParametersError(hostname_error)
+
+        base_config = build_base_configs(configuration_parameters)
+        if configuration_parameters.get('deployment_type', '') == 'openstack':
+            base_config = build_openstack_heat(base_config, configuration_parameters, archive=True)
+
+        return dict(hostname=hostname, success=True, files=base_config)
+
+    except (RequiredParametersError, TemplateNotFoundError, TemplateError) as e:
+        return dict(hostname=hostname, success=False, message=str(e))
+    finally:
+        db_session.remove()
+
+
+def iter_batch_configs(shared_parameters, devices):
+    """
+    Builds the configuration files for many devices at once. Each device is rendered in a pool of worker processes
+    and the results are yielded in order as soon as they are ready, so the caller can begin to stream out the first
+    devices while the rest are still being rendered
+    :param shared_parameters: dict of parameters common to all devices
+    :param devices: list of dicts containing the device specific parameters, such as hostname, management_ip, etc.
+    Each of these will override the shared parameters
+    :return: generator of dicts as returned from _build_batch_device in the same order as devices
+    """
+    # list of (hostname, configuration_parameters or error message) tuples
+    payloads = list()
+    seen_hostnames = set()
+    for device in devices:
+        configuration_parameters = dict(shared_parameters)
+        configuration_parameters.update(device)
+        hostname = configuration_parameters.get('hostname', None)
+        # checked before the hostname is hashed, it may be any json value
+        hostname_error = _get_hostname_error(hostname)
+        if hostname_error is not None:
+            payloads.append((hostname, hostname_error))
+            continue
+
+        if hostname in seen_hostnames:
+            payloads.append((hostname, 'Duplicate hostname in batch'))
+            continue
+
+        seen_hostnames.add(hostname)
+        payloads.append((hostname, configuration_parameters))
+
+    to_build = [p for h, p in payloads if isinstance(p, dict)]
+
+    # a pool inherited from a parent process, such as a preloading gunicorn master, has no threads left to feed it
+    if len(to_build) <= 1 or _batch_pool is None or _batch_pool_pid != os.getpid():
+        built = (_build_batch_device(p) for p in to_build)
+    else:
+        chunk_size = max(1, len(to_build) // (_batch_workers * 4))
+        built = _batch_pool.imap(_build_batch_device, to_build, chunksize=chunk_size)
+
+    for hostname, configuration_parameters in payloads:
+        if isinstance(configuration_parameters, dict):
+            yield next(built)
+        else:
+            yield dict(hostname=hostname, success=False, message=configuration_parameters)
+
+
+def build_batch_configs(shared_parameters, devices):
+    """
+    Builds the configuration files for many devices at once, see iter_batch_configs
+    :param shared_parameters: dict of parameters common to all devices
+    :param devices: list of dicts containing the device specific parameters
+    :return: list of dicts as returned from _build_batch_device in the same order as devices
+    """
+    return list(iter_batch_configs(shared_parameters, devices))
+
+
+def iter_batch_files(results):
+    """
+    Converts the results of a batch build into entries of a single files dict with one directory per hostname,
+    followed by a manifest.json with the status of each device
+    :param results: iterable of dicts as returned from iter_batch_configs
+    :return: generator of (FILENAME, file dict) tuples suitable for the archive_utils functions
+    """
+    manifest = list()
+    for result in results:
+        files = result.pop('files', None)
+        manifest.append(result)
+        if files is None:
+            continue
+
+        hostname = result['hostname']
+        for f in files:
+            yield '%s/%s' % (hostname, f), dict(contents=files[f]['contents'], file_name=f,
+                                                archive_path='%s/%s' % (hostname, files[f]['archive_path']))
+
+    yield 'manifest.json', dict(contents=json.dumps(manifest, indent=2), archive_path='.')
 
 
 def unescape(s):
@@ -1,31 +1,299 @@
-
-from werkzeug.contrib.cache import FileSystemCache
+import logging
 import os
+import pickle
+import re
+import struct
+import threading
+import time
 import uuid
+from collections import OrderedDict
+
+from . import fs_utils
+from . import metrics_utils
+
+log = logging.getLogger(__name__)
 
 # cache the cache yo
 __cache = None
 
+# keys are used as file names, so never allow anything that could escape the cache directory
+_valid_key = re.compile(r'^[A-Za-z0-9_-]+$')
 
-def __get_cache():
+# every cache file begins with the time it expires, so the sweeper does not need to unpickle anything
+_expires_header = struct.Struct('>d')
+
+
+class CacheBackend(object):
+    """
+    Interface of all cache backends. Keys are always strings, values any picklable object
+    """
+
+    def get(self, key):
+        """
+        :param key: key of the object to retrieve
+        :return: object or None if not found or expired
+        """
+        raise NotImplementedError
+
+    def set(self, key, obj, timeout=None):
+        """
+        :param key: key of the object to store
+        :param obj: object to store
+        :param timeout: number of seconds to keep the object around, the backend default is used if None
+        :return: boolean
+        """
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    In process LRU cache bounded by the total size of the pickled objects it holds. When a backing cache is given,
+    every set is written through to it and misses are read from it, so this can be used as a hot tier in front of a
+    cache that is shared between processes
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, default_timeout=300, backing_cache=None):
+        self._max_bytes = max_bytes
+        self._default_timeout = default_timeout
+        self._backing_cache = backing_cache
+        # key -> (expires, obj, size)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # the lock may be held by another thread at the moment a batch worker is forked
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        expires, obj, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+
+                self._remove(key)
+
+        if self._backing_cache is not None:
+            return self._backing_cache.get(key)
+
+        return None
+
+    def set(self, key, obj, timeout=None):
+        if timeout is None:
+            timeout = self._default_timeout
+
+        if self._backing_cache is not None and not self._backing_cache.set(key, obj, timeout):
+            return False
+
+        size = len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        if size > self._max_bytes:
+            # never going to fit, the backing cache will have to do
+            return self._backing_cache is not None
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.time() + timeout, obj, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+        return True
+
+
+class ShardedFileCache(CacheBackend):
+    """
+    File system cache that spreads entries over sharded sub directories. Set and get touch exactly one file and never
+    list the cache directory. Expired entries are removed by a background sweeper thread instead of inline
+    """
+
+    def __init__(self, cache_dir='/tmp/bootstrapper/cache', default_timeout=300, sweep_interval=60):
+        self._cache_dir = cache_dir
+        self._default_timeout = default_timeout
+        self._sweep_interval = sweep_interval
+        self._sweeper = None
+        if sweep_interval > 0:
+            self._start_sweeper()
+
+    def _get_path(self, key):
+        # keys are uuid4 strings, the first two characters give us 256 evenly used shards
+        return os.path.join(self._cache_dir, key[:2], key)
+
+    def get(self, key):
+        if not _valid_key.match(key):
+            return None
+
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                expires = _expires_header.unpack(f.read(_expires_header.size))[0]
+                if expires <= time.time():
+                    return None
+
+                return pickle.load(f)
+
+        except (OSError, EOFError, struct.error, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, obj, timeout=None):
+        if timeout is None:
+            timeout = self._default_timeout
+
+        if not _valid_key.match(key):
+            return False
+
+        path = self._get_path(key)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4())
+        data = _expires_header.pack(time.time() + timeout) + pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        try:
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileNotFoundError:
+                # first entry in this shard
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.replace(tmp_path, path)
+            return True
+
+        except OSError as oe:
+            log.error('Could not write cache entry: %s', oe)
+            return False
+
+    def sweep(self):
+        """
+        Removes all expired entries from the cache directory
+        :return: number of entries removed
+        """
+        removed = 0
+        now = time.time()
+        try:
+            shards = [s.path for s in os.scandir(self._cache_dir) if s.is_dir()]
+        except OSError:
+            return removed
+
+        for shard in shards:
+            try:
+                entries = list(os.scandir(shard))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.name.endswith('.tmp'):
+                        # left over from an interrupted set, give it plenty of time to complete first
+                        if entry.stat().st_mtime + self._default_timeout <= now:
+                            os.remove(entry.path)
+                            removed += 1
+                        continue
+
+                    with open(entry.path, 'rb') as f:
+                        expires = _expires_header.unpack(f.read(_expires_header.size))[0]
+
+                    if expires <= now:
+                        os.remove(entry.path)
+                        removed += 1
+
+                except (OSError, struct.error):
+                    continue
+
+        return removed
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self._sweep_interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    log.info('Removed %d expired cache entries', removed)
+            except Exception as e:
+                # never let the sweeper die
+                log.error('Could not sweep cache directory: %s', e)
+
+    def _start_sweeper(self):
+        self._sweeper = threading.Thread(target=self._sweep_forever, name='cache-sweeper', daemon=True)
+        self._sweeper.start()
+
+
+class WerkzeugFileSystemCache(CacheBackend):
+    """
+    The original werkzeug FileSystemCache. This scans and prunes the whole cache directory once it holds more than
+    'threshold' entries, so it does not scale with load and is only kept for compatibility
     """
-    Simple wrapper around SimpleCache
-    This should make it easy to swap out cache implementations later if needed
+
+    def __init__(self, cache_dir='/tmp/bootstrapper/cache', default_timeout=300, threshold=256):
+        from werkzeug.contrib.cache import FileSystemCache
+        self._cache = FileSystemCache(cache_dir=cache_dir, threshold=threshold, default_timeout=default_timeout,
+                                      mode=0o600)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, obj, timeout=None):
+        return self._cache.set(key, obj, timeout)
+
+
+def init_cache(cache_config):
+    """
+    Creates the cache backend from the 'cache' section of the configuration.yaml file
+    :param cache_config: dict with the following optional keys:
+        backend: 'filesystem' (default), 'memory', or 'werkzeug'
+        directory: directory of the filesystem and werkzeug backends, the memory backend is used instead if it is
+        not a private directory of the current user
+        default_timeout: number of seconds objects are kept in the cache
+        memory_bytes: size of the in memory LRU tier in front of the filesystem backend, 0 to disable
+        sweep_interval: number of seconds between each scan for expired entries of the filesystem backend
     :return: cache object
     """
     global __cache
 
-    if not os.path.exists('/tmp/bootstrapper/cache'):
-        os.makedirs('/tmp/bootstrapper/cache')
+    backend = cache_config.get('backend', 'filesystem')
+    cache_dir = cache_config.get('directory', '/tmp/bootstrapper/cache')
+    default_timeout = cache_config.get('default_timeout', 300)
+    memory_bytes = cache_config.get('memory_bytes', 16 * 1024 * 1024)
+
+    if backend != 'memory':
+        try:
+            # entries are unpickled when read, so keep everyone else out of the directory
+            fs_utils.make_private_directory(cache_dir)
+        except OSError as oe:
+            log.error('Could not create cache directory, caching in memory only: %s', oe)
+            backend = 'memory'
+            memory_bytes = memory_bytes or 16 * 1024 * 1024
+
+    if backend == 'memory':
+        __cache = MemoryCache(max_bytes=memory_bytes, default_timeout=default_timeout)
+    elif backend == 'werkzeug':
+        __cache = WerkzeugFileSystemCache(cache_dir=cache_dir, default_timeout=default_timeout)
+    else:
+        __cache = ShardedFileCache(cache_dir=cache_dir, default_timeout=default_timeout,
+                                   sweep_interval=cache_config.get('sweep_interval', 60))
+        if memory_bytes > 0:
+            __cache = MemoryCache(max_bytes=memory_bytes, default_timeout=default_timeout, backing_cache=__cache)
+
+    return __cache
+
 
+def __get_cache():
+    """
+    Returns the configured cache backend, falling back to the defaults if init_cache has not been called
+    :return: cache object
+    """
     if __cache is not None:
         return __cache
 
-    try:
-        __cache = FileSystemCache(cache_dir='/tmp/bootstrapper/cache/', threshold=256, default_timeout=300, mode=0o600)
-        return __cache
-    except OSError:
-        raise
+    return init_cache(dict())
 
 
 def set(obj):
@@ -36,7 +304,10 @@ def set(obj):
     """
     key = str(uuid.uuid4())
     c = __get_cache()
-    if c.set(key, obj):
+    with metrics_utils.stage_seconds.time('cache_write'):
+        stored = c.set(key, obj)
+
+    if stored:
         return key
     else:
         return None
@@ -49,4 +320,8 @@ def get(key):
     :return: object in question or None on error or not found
     """
     c = __get_cache()
-    return c.get(key)
+    with metrics_utils.stage_seconds.time('cache_read'):
+        obj = c.get(key)
+
+    metrics_utils.cache_requests.inc('miss' if obj is None else 'hit')
+    return obj
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import threading
+
+# key -> _Call of the builds that are currently in flight
+_calls = dict()
+_lock = threading.Lock()
+_stats = {'leaders': 0, 'coalesced': 0}
+
+
+class _Call(object):
+    """
+    A single build that any number of identical requests are waiting on
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_key(*parts):
+    """
+    Returns a canonical hash of the given json serializable objects. Dicts hash the same regardless of key order
+    :param parts: json serializable objects, such as the posted json
+    :return: hex digest
+    """
+    canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def do(key, fn):
+    """
+    Runs fn unless an identical call with the same key is already running in this process, in which case this waits
+    for it to finish and shares it's result. Exceptions raised by fn are raised in every waiting caller as well
+    :param key: key identifying identical calls, see get_key
+    :param fn: function without arguments to run
+    :return: tuple of (result of fn, boolean True if the result was shared from another call)
+    """
+    with _lock:
+        call = _calls.get(key, None)
+        if call is None:
+            call = _Call()
+            _calls[key] = call
+            _stats['leaders'] += 1
+            leader = True
+        else:
+            _stats['coalesced'] += 1
+            leader = False
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+
+        return call.result, True
+
+    try:
+        call.result = fn()
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        # later requests must start a new build, they may have been made after the templates changed
+        with _lock:
+            del _calls[key]
+        call.done.set()
+
+    return call.result, False
+
+
+def get_stats():
+    """
+    :return: dict containing 'leaders', 'coalesced', and 'in_flight' keys
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats['in_flight'] = len(_calls)
+
+    return stats
@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+from types import MappingProxyType
+
+import yaml
+
+from bootstrapper.lib.exceptions import InvalidConfigurationError
+
+log = logging.getLogger(__name__)
+
+_conf_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'conf'))
+
+
+def freeze(obj):
+    """
+    Returns a read only copy of the given object. Dicts become MappingProxyType objects and lists become tuples, all
+    the way down, so callers can never modify the shared copy by accident
+    :param obj: object loaded from a yaml file
+    :return: read only copy of obj
+    """
+    if isinstance(obj, dict):
+        return MappingProxyType(dict((k, freeze(v)) for k, v in obj.items()))
+
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+
+    return obj
+
+
+class ConfigFile(object):
+    """
+    A yaml file that is parsed once and only parsed again when the file modification time changes or reload is
+    called. Callers get a read only view of the parsed file
+    """
+
+    def __init__(self, file_name, validate=None):
+        """
+        :param file_name: name of the file in the bootstrapper/conf directory
+        :param validate: optional function that takes the parsed dict and returns the dict to use
+        """
+        self.path = os.path.join(_conf_dir, file_name)
+        self._validate = validate
+        self._view = None
+        # modification time of the file when it was last parsed, None forces a reload on the next get
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self, mtime):
+        try:
+            with open(self.path) as config_file:
+                obj = yaml.safe_load(config_file.read())
+
+        except (OSError, yaml.YAMLError) as e:
+            if self._view is not None:
+                # keep serving the last good copy until the file is fixed
+                log.error('Could not reload %s, keeping previous version: %s', self.path, e)
+                self._mtime = mtime
+                return self._view
+
+            log.error('Could not load %s: %s', self.path, e)
+            raise InvalidConfigurationError('Could not load configuration file %s' % os.path.basename(self.path))
+
+        if type(obj) is not dict:
+            log.warning('Unknown config object in %s', self.path)
+            obj = dict()
+
+        if self._validate is not None:
+            obj = self._validate(obj)
+
+        self._view = freeze(obj)
+        self._mtime = mtime
+        log.info('Loaded configuration file %s', self.path)
+        return self._view
+
+    def get(self):
+        """
+        Returns the parsed file, parsing it again first if it has changed on disk
+        :return: read only dict like object
+        """
+        mtime = self._get_mtime()
+        view = self._view
+        if view is not None and self._mtime is not None and mtime == self._mtime:
+            return view
+
+        with self._lock:
+            # another thread may have reloaded while we were waiting on the lock
+            if self._view is not view and self._mtime is not None and mtime == self._mtime:
+                return self._view
+
+            return self._load(mtime)
+
+    def invalidate(self):
+        """
+        Forces the file to be parsed again on the next get. This does no IO and is safe to call from a signal handler
+        :return: None
+        """
+        self._mtime = None
+
+
+def _validate_config(config):
+    if 'template_locations' not in config:
+        log.warning('invalid configuration found, template_locations is missing')
+        config['template_locations'] = list()
+
+    return config
+
+
+configuration = ConfigFile('configuration.yaml', validate=_validate_config)
+defaults = ConfigFile('defaults.yaml')
+
+
+def reload():
+    """
+    Parses all configuration files again, used by the reload_config endpoint and the SIGHUP handler
+    :return: None
+    """
+    for config_file in (configuration, defaults):
+        config_file.invalidate()
+        config_file.get()
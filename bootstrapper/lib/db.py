@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy import inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -15,4 +16,19 @@ def init_db():
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     import bootstrapper.lib.db_models
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    _upgrade_db()
+
+
+def _upgrade_db():
+    # add any columns that have been introduced since the table was first created. create_all will not
+    # modify existing tables
+    columns = [c['name'] for c in inspect(engine).get_columns('templates')]
+    if 'variables' not in columns:
+        engine.execute('ALTER TABLE templates ADD COLUMN variables VARCHAR')
+
+    indexes = [i['name'] for i in inspect(engine).get_indexes('templates')]
+    if 'ix_templates_type' not in indexes:
+        engine.execute('CREATE INDEX ix_templates_type ON templates (type)')
+    if 'ix_templates_name' not in indexes:
+        engine.execute('CREATE UNIQUE INDEX ix_templates_name ON templates (name)')
@@ -1,24 +1,47 @@
+import json
+
 from sqlalchemy import Column, Integer, String
 from .db import Base
+from . import template_utils
 
 
 class Template(Base):
     __tablename__ = 'templates'
     id = Column(Integer, primary_key=True)
     # simple name of the template
-    name = Column(String(50), unique=True)
+    name = Column(String(50), unique=True, index=True)
     # type of the template - bootstrap or init-cfg-static.txt
-    type = Column(String(32), unique=False)
+    type = Column(String(32), unique=False, index=True)
     # simple description of this template
     description = Column(String(120), unique=False)
     # actual text of the jinja template
     template = Column(String(), unique=False)
+    # json encoded list of the undeclared variables found in the template text
+    variables = Column(String(), unique=False)
 
     def __init__(self, name=None, description=None, type='bootstrap', template=""):
         self.name = name
         self.description = description
         self.type = type
         self.template = template
+        self.update_variables()
+
+    def update_variables(self):
+        """
+        Parses the template text and stores the set of required variables alongside it. This must be called
+        any time the template text changes
+        :return: None
+        """
+        self.variables = json.dumps(sorted(template_utils.find_variables(self.template)))
+
+    def get_variables(self):
+        """
+        :return: set of variable names required by this template
+        """
+        if self.variables is None:
+            self.update_variables()
+
+        return set(json.loads(self.variables))
 
     def __repr__(self):
-        return '<Template %r>' % (self.name)
\ No newline at end of file
+        return '<Template %r>' % (self.name)
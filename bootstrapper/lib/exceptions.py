@@ -8,3 +8,7 @@ class TemplateNotFoundError(Exception):
 
 class InvalidConfigurationError(Exception):
     """Custom error to denote when a template is not found"""
+
+
+class QueueFullError(Exception):
+    """Custom error to denote when the job queue cannot take any more jobs"""
@@ -0,0 +1,37 @@
+import os
+import stat
+
+
+def check_private_directory(directory):
+    """
+    Makes sure nobody else can write to the directory. It may already have existed, for example when another local
+    user created it first in a shared location such as /tmp. The parent directory is checked as well, whoever can
+    write to it can replace the directory
+    :param directory: path of the directory
+    :return: None
+    :raises OSError: when the directory is not a private directory of the current user
+    """
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or (hasattr(os, 'getuid') and st.st_uid != os.getuid()):
+        raise OSError('%s is not a directory owned by the current user' % directory)
+
+    if st.st_mode & 0o077:
+        # ours, but created with a loose umask
+        os.chmod(directory, stat.S_IRWXU)
+
+    parent = os.stat(os.path.dirname(os.path.abspath(directory)))
+    trusted_owners = (0, os.getuid()) if hasattr(os, 'getuid') else (parent.st_uid,)
+    # a sticky directory such as /tmp itself does not let others rename or remove what they do not own
+    if parent.st_uid not in trusted_owners or (parent.st_mode & 0o022 and not parent.st_mode & stat.S_ISVTX):
+        raise OSError('The parent directory of %s can be written to by other users' % directory)
+
+
+def make_private_directory(directory):
+    """
+    Creates the directory if it does not exist yet and makes sure nobody else can write to it
+    :param directory: path of the directory
+    :return: None
+    :raises OSError: when the directory could not be created or is not a private directory of the current user
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    check_private_directory(directory)
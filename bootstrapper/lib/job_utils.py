@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from bootstrapper.lib import fs_utils
+from bootstrapper.lib.exceptions import QueueFullError
+
+log = logging.getLogger(__name__)
+
+# number of jobs that are built at the same time
+_workers = 2
+# number of jobs that may be waiting for a worker, any more are rejected
+_max_queue = 32
+# number of seconds a finished job is remembered
+_ttl = 600
+# the status of every job is kept here, so any worker process can report on jobs submitted to another
+_job_dir = '/tmp/bootstrapper/jobs'
+# seconds between each check of the status file of a job running in another worker process
+_poll_interval = 0.25
+# job ids are used as file names, so never allow anything that could escape the job directory
+_valid_job_id = re.compile(r'^[0-9a-f-]+$')
+
+_executor = None
+# job_id -> Job, oldest first
+_jobs = OrderedDict()
+_lock = threading.Lock()
+_stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+# number of jobs waiting for a worker and being worked on right now
+_depth = {'queued': 0, 'running': 0}
+# time the job directory was last swept for expired status files
+_last_sweep = 0.0
+
+
+class Job(object):
+    """
+    A single unit of work submitted to the job pool. The job is run by the process it was submitted to, every other
+    process sees a copy loaded from it's status file
+    """
+
+    def __init__(self, job_id, local=True):
+        self.job_id = job_id
+        # queued, running, complete, or failed
+        self.status = 'queued'
+        self.message = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        # only set in the process that runs the job
+        self._done = threading.Event() if local else None
+
+    def wait(self, timeout):
+        """
+        Blocks until the job is finished or the timeout expires
+        :param timeout: maximum number of seconds to wait
+        :return: boolean, True if the job is finished
+        """
+        if self._done is not None:
+            return self._done.wait(timeout)
+
+        # running in another worker process, watch it's status file instead
+        deadline = time.monotonic() + timeout
+        while self.finished is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(_poll_interval, remaining))
+            job = _load(self.job_id)
+            if job is None:
+                return False
+
+            self.status = job.status
+            self.message = job.message
+            self.result = job.result
+            self.finished = job.finished
+
+        return True
+
+    def to_dict(self):
+        """
+        :return: dict containing 'job_id', 'status', 'message', 'created', and 'finished' keys
+        """
+        return dict(job_id=self.job_id, status=self.status, message=self.message, created=self.created,
+                    finished=self.finished)
+
+
+def init_jobs(job_config):
+    """
+    Configures the job pool from the 'jobs' section of the configuration.yaml file
+    :param job_config: dict with the following optional keys: 'workers', 'max_queue', 'ttl', 'directory'
+    :return: None
+    """
+    global _workers, _max_queue, _ttl, _job_dir, _executor
+
+    _workers = job_config.get('workers', _workers)
+    _max_queue = job_config.get('max_queue', _max_queue)
+    _ttl = job_config.get('ttl', _ttl)
+    _job_dir = job_config.get('directory', _job_dir)
+    _executor = None
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_workers)
+
+    return _executor
+
+
+def _get_status_path(job_id):
+    return os.path.join(_job_dir, '%s.json' % job_id)
+
+
+def _save(job):
+    """
+    Writes the status file of a job. The file is written to a temporary file first and then moved into place, so
+    other processes never read a partially written status
+    :param job: Job
+    :return: None
+    """
+    status_path = _get_status_path(job.job_id)
+    tmp_path = '%s.%s.tmp' % (status_path, uuid.uuid4())
+    try:
+        # the result names the archive that is served for the job, so keep everyone else out of the directory
+        fs_utils.make_private_directory(_job_dir)
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(job.to_dict(), result=job.result), f)
+
+        os.replace(tmp_path, status_path)
+
+    except (OSError, TypeError, ValueError) as e:
+        # the job still runs, it can only be followed from this process
+        log.error('Could not save status of job %s: %s', job.job_id, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load(job_id):
+    """
+    :param job_id: id of the job
+    :return: Job loaded from it's status file or None if not found or expired
+    """
+    try:
+        # never trust a status file in a directory someone else could have written it to
+        fs_utils.check_private_directory(_job_dir)
+        with open(_get_status_path(job_id), 'r') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if status['finished'] is not None and status['finished'] <= time.time() - _ttl:
+        return None
+
+    job = Job(job_id, local=False)
+    job.status = status['status']
+    job.message = status['message']
+    job.result = status['result']
+    job.created = status['created']
+    job.finished = status['finished']
+    return job
+
+
+def _sweep():
+    """
+    Removes the status files of all jobs that were last updated more than ttl seconds ago, at most once a minute
+    :return: None
+    """
+    global _last_sweep
+
+    now = time.time()
+    with _lock:
+        if now - _last_sweep < 60:
+            return
+        _last_sweep = now
+
+    try:
+        for f in os.listdir(_job_dir):
+            path = os.path.join(_job_dir, f)
+            if os.stat(path).st_mtime <= now - _ttl:
+                os.remove(path)
+    except OSError as oe:
+        # another worker may be sweeping at the same time
+        log.warning('Could not sweep job directory: %s', oe)
+
+
+def _prune():
+    """
+    Forgets all jobs that finished more than ttl seconds ago, must be called with the lock held
+    :return: None
+    """
+    expires = time.time() - _ttl
+    for job_id in [j.job_id for j in _jobs.values() if j.finished is not None and j.finished <= expires]:
+        del _jobs[job_id]
+
+
+def _run(job, fn, args, kwargs):
+    with _lock:
+        job.status = 'running'
+        _depth['queued'] -= 1
+        _depth['running'] += 1
+
+    _save(job)
+    try:
+        result = fn(*args, **kwargs)
+        with _lock:
+            job.result = result
+            job.status = 'complete'
+            _stats['completed'] += 1
+            _depth['running'] -= 1
+
+    except Exception as e:
+        log.error('Job %s failed: %s', job.job_id, e)
+        with _lock:
+            job.message = str(e)
+            job.status = 'failed'
+            _stats['failed'] += 1
+            _depth['running'] -= 1
+
+    finally:
+        job.finished = time.time()
+        _save(job)
+        job._done.set()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Queues fn to be run by the job pool
+    :param fn: function to run, it's return value becomes the job result and must be json serializable. Any exception
+    it raises fails the job
+    :param args: positional arguments for fn
+    :param kwargs: keyword arguments for fn
+    :return: Job
+    :raises QueueFullError: when max_queue jobs are already waiting for a worker
+    """
+    with _lock:
+        _prune()
+        if _depth['queued'] >= _max_queue:
+            _stats['rejected'] += 1
+            raise QueueFullError('Job queue is full')
+
+        job = Job(str(uuid.uuid4()))
+        _jobs[job.job_id] = job
+        _stats['submitted'] += 1
+        _depth['queued'] += 1
+
+    _sweep()
+    _save(job)
+    _get_executor().submit(_run, job, fn, args, kwargs)
+    return job
+
+
+def get(job_id):
+    """
+    :param job_id: id of the job as returned from submit, it may have been submitted to any worker process
+    :return: Job or None if not found or already forgotten
+    """
+    with _lock:
+        job = _jobs.get(job_id, None)
+
+    if job is not None:
+        return job
+
+    if not _valid_job_id.match(job_id):
+        return None
+
+    return _load(job_id)
+
+
+def get_stats():
+    """
+    Reports the current state of the job pool
+    :return: dict containing 'queued', 'running', 'workers', 'max_queue', 'submitted', 'completed', 'failed', and
+    'rejected' keys
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats.update(_depth)
+
+    stats['workers'] = _workers
+    stats['max_queue'] = _max_queue
+    return stats
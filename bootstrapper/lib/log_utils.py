@@ -0,0 +1,102 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# all loggers of the bootstrapper are children of this one
+_logger_name = 'bootstrapper'
+
+# attributes every LogRecord has, anything else was passed in with extra= and is logged as a structured field
+_record_attributes = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+_listener = None
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a single line json object. Fields given with extra= are added as keys of their own, so
+    the log shipper can index them
+    """
+
+    def format(self, record):
+        entry = dict(time=datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                     level=record.levelname, logger=record.name, message=record.getMessage())
+        for k, v in record.__dict__.items():
+            if k not in _record_attributes:
+                entry[k] = v
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats each record as a plain text line followed by the structured fields as key=value pairs
+    """
+
+    def __init__(self):
+        super(TextFormatter, self).__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super(TextFormatter, self).format(record)
+        fields = ' '.join('%s=%s' % (k, v) for k, v in record.__dict__.items() if k not in _record_attributes)
+        return '%s %s' % (line, fields) if fields else line
+
+
+def init_logging(log_config):
+    """
+    Configures logging from the 'logging' section of the configuration.yaml file. Records are put on a queue by the
+    request threads and written out by a background thread, so a slow stdout never holds up a request. Calling this
+    again only changes the level
+    :param log_config: dict with the following optional keys: 'level', 'format'
+    :return: None
+    """
+    global _listener, _handler
+
+    logger = logging.getLogger(_logger_name)
+    logger.setLevel(log_config.get('level', 'INFO').upper())
+
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if log_config.get('format', 'json') == 'text':
+        output.setFormatter(TextFormatter())
+    else:
+        output.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    _handler = logging.handlers.QueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    # write out whatever is still queued on the way out
+    atexit.register(_listener.stop)
+
+    logger.addHandler(_handler)
+    # the records are written by the listener, do not write them a second time through the root logger
+    logger.propagate = False
+
+
+def init_worker_logging(log_config):
+    """
+    Configures logging in a forked worker process. The listener thread of the parent process does not exist in the
+    worker, so anything inherited from the parent is dropped before logging is set up again
+    :param log_config: dict with the following optional keys: 'level', 'format'
+    :return: None
+    """
+    global _listener, _handler
+
+    if _handler is not None:
+        logging.getLogger(_logger_name).removeHandler(_handler)
+
+    _listener = None
+    _handler = None
+    init_logging(log_config)
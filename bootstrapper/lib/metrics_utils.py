@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# all registered metrics in the order they are exposed
+_registry = list()
+
+# upper bounds of the stage duration histogram buckets in seconds
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _Metric(object):
+    """
+    Base class of all metrics. Samples are kept per combination of label values. Metrics with a callback have no
+    samples of their own, the callback is only called when the metrics are exposed. It returns a single value, or a
+    dict of label value tuples to values for metrics with labels
+    """
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._callback = callback
+        self._values = dict()
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self):
+        """
+        :return: list of (suffix, label values, extra label, value) tuples
+        """
+        if self._callback is not None:
+            values = self._callback()
+            if not isinstance(values, dict):
+                return [('', (), None, values)]
+
+            return [('', labels, None, value) for labels, value in sorted(values.items())]
+
+        with self._lock:
+            return [('', labels, None, value) for labels, value in sorted(self._values.items())]
+
+    def expose(self):
+        """
+        :return: list of lines in the prometheus text format
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+        for suffix, labels, extra, value in self._samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(self.label_names, labels, extra),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """
+        :param labels: label values in the order of label_names
+        :param amount: amount to add
+        :return: None
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    @contextmanager
+    def track(self, *labels):
+        """
+        Counts the code in the with block as in progress for as long as it runs
+        :param labels: label values in the order of label_names
+        """
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        :param value: observed value, such as a duration in seconds
+        :param labels: label values in the order of label_names
+        :return: None
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels, None)
+            if entry is None:
+                # per bucket counts, the last one is +Inf, followed by the sum
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            entry[i] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observes the duration of the with block in seconds
+        :param labels: label values in the order of label_names
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(labels, list(entry)) for labels, entry in sorted(self._values.items())]
+
+        samples = list()
+        bounds = self.buckets + (float('inf'),)
+        for labels, entry in values:
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                samples.append(('_bucket', labels, ('le', _format_value(bound)), cumulative))
+
+            samples.append(('_sum', labels, None, entry[-1]))
+            samples.append(('_count', labels, None, cumulative))
+
+        return samples
+
+
+def expose():
+    """
+    Renders all registered metrics. Metrics are kept per worker process, so every worker exposes it's own values
+    :return: string in the prometheus text format
+    """
+    lines = list()
+    for metric in _registry:
+        lines.extend(metric.expose())
+
+    return '\n'.join(lines) + '\n'
+
+
+# metrics of the bootstrap package pipeline, updated from the hot path of the bootstrapper_utils, archive_utils,
+# cache_utils, and store_utils modules. Everything else is gathered only when the metrics are exposed
+stage_seconds = Histogram('bootstrapper_stage_duration_seconds',
+                          'Time spent in each stage of building a bootstrap package', ['stage'])
+cache_requests = Counter('bootstrapper_cache_requests_total', 'Cache lookups by result', ['result'])
+archive_store_requests = Counter('bootstrapper_archive_store_requests_total', 'Archive store lookups by result',
+                                 ['result'])
+archives = Counter('bootstrapper_archives_total', 'Archives built by type and mode', ['type', 'mode'])
+builds_in_flight = Gauge('bootstrapper_builds_in_flight', 'Archives being built right now', ['type'])
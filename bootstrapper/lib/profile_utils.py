@@ -0,0 +1,118 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+# header or query parameter a client uses to ask for it's request to be profiled
+request_header = 'X-Bootstrapper-Profile'
+request_arg = 'profile'
+# header the id of the written profile is returned in
+response_header = 'X-Bootstrapper-Profile-Id'
+
+_lock = threading.Lock()
+# time the last profile was started, used to rate limit profiling
+_last_started = 0.0
+# number of profiles being recorded right now
+_active = 0
+_stats = {'profiled': 0, 'rate_limited': 0}
+
+
+def start(profile_config, token):
+    """
+    Starts profiling the current request if profiling is enabled and the rate limit allows it. Only one request is
+    profiled at a time and at most one every 'min_interval' seconds per worker process, so asking for profiles can
+    never slow the whole service down
+    :param profile_config: dict of the 'profiling' section of the configuration.yaml file with the following keys:
+    'enabled', 'token', 'min_interval'
+    :param token: value of the profile header or query parameter sent by the client
+    :return: enabled cProfile.Profile or None if the request will not be profiled
+    """
+    global _last_started, _active
+
+    if not profile_config.get('enabled', False):
+        return None
+
+    # when a token is configured, only clients that know it may ask for a profile
+    expected = profile_config.get('token', None)
+    if expected and token != expected:
+        return None
+
+    now = time.monotonic()
+    with _lock:
+        if _active or now - _last_started < profile_config.get('min_interval', 10):
+            _stats['rate_limited'] += 1
+            return None
+
+        _last_started = now
+        _active += 1
+        _stats['profiled'] += 1
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop(profiler, profile_config):
+    """
+    Stops the profiler and writes the profile into the profile directory. The oldest profiles are removed once there
+    are more than 'max_profiles' of them
+    :param profiler: cProfile.Profile as returned from start
+    :param profile_config: dict of the 'profiling' section of the configuration.yaml file with the following keys:
+    'directory', 'max_profiles'
+    :return: id of the profile or None if it could not be written
+    """
+    global _active
+
+    profiler.disable()
+    with _lock:
+        _active -= 1
+
+    directory = profile_config.get('directory', '/tmp/bootstrapper/profiles')
+    # ids sort in the order the profiles were taken
+    profile_id = '%d-%s' % (time.time() * 1000, uuid.uuid4().hex[:8])
+    profile_path = os.path.join(directory, '%s.prof' % profile_id)
+    tmp_path = profile_path + '.tmp'
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, profile_path)
+    except OSError as oe:
+        log.error('Could not write profile: %s', oe)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+    _rotate(directory, profile_config.get('max_profiles', 50))
+    log.info('Wrote profile %s', profile_path)
+    return profile_id
+
+
+def _rotate(directory, max_profiles):
+    """
+    Removes the oldest profiles until at most max_profiles are left
+    :param directory: profile directory
+    :param max_profiles: number of profiles to keep
+    :return: None
+    """
+    try:
+        profiles = sorted(f for f in os.listdir(directory) if f.endswith('.prof'))
+        for f in profiles[:max(0, len(profiles) - max_profiles)]:
+            os.remove(os.path.join(directory, f))
+    except OSError as oe:
+        # another worker may have removed it already
+        log.warning('Could not rotate profiles: %s', oe)
+
+
+def get_stats():
+    """
+    :return: dict containing 'profiled', 'rate_limited', and 'active' keys
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats['active'] = _active
+
+    return stats
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from bootstrapper.lib.db import db_session
+from bootstrapper.lib.db import engine
+from bootstrapper.lib.db_models import Template
+
+log = logging.getLogger(__name__)
+
+# read only copy of the metadata of a single row of the template table, the template text is kept by the snapshot
+TemplateRecord = namedtuple('TemplateRecord', ['name', 'description', 'type', 'variables'])
+
+# the current snapshot, this is only ever replaced as a whole and never modified
+_snapshot = None
+# only one thread needs to reload the snapshot when the database changes
+_reload_lock = threading.Lock()
+# number of snapshots loaded by this process, used as the version when the database file cannot be checked
+_generation = 0
+# maximum number of serialized responses kept per snapshot, see TemplateSnapshot.get_response
+_max_responses = 256
+
+
+class TemplateSnapshot(object):
+    """
+    Immutable in process copy of the whole template table. Everything, including the template texts, is loaded up
+    front, so serving a request from a snapshot never touches the database. The price is that every worker process
+    holds all template texts in memory, twice for a moment while a new snapshot replaces the old one
+    """
+
+    def __init__(self, version, records, texts):
+        """
+        :param version: version of the database file when this snapshot was loaded, see _get_db_version
+        :param records: list of TemplateRecord in table order
+        :param texts: dict of template name to template text
+        """
+        self.version = version
+        if version is not None:
+            # every worker process sees the same database file, so they will all hand out the same ETag
+            self.etag = hashlib.sha1(repr(version).encode('utf-8')).hexdigest()
+            self.last_modified = datetime.utcfromtimestamp(version[0] // 10 ** 9)
+        else:
+            self.etag = '%d-%d' % (os.getpid(), _generation)
+            self.last_modified = datetime.utcnow().replace(microsecond=0)
+        self.templates = MappingProxyType(dict((r.name, r) for r in records))
+        self.records = tuple(records)
+        by_type = dict()
+        for r in records:
+            by_type.setdefault(r.type, list()).append(r)
+        self._by_type = dict((t, tuple(rs)) for t, rs in by_type.items())
+        self._texts = MappingProxyType(texts)
+        # serialized responses derived from this snapshot, see get_response
+        self._responses = dict()
+
+    def get(self, template_name):
+        """
+        :param template_name: name of the template
+        :return: TemplateRecord or None if not found
+        """
+        return self.templates.get(template_name, None)
+
+    def get_text(self, template_name):
+        """
+        :param template_name: name of the template
+        :return: string containing the template text or None if not found
+        """
+        return self._texts.get(template_name, None)
+
+    def get_response(self, key, build):
+        """
+        Returns a response body that only depends on the contents of this snapshot, building it the first time it is
+        asked for. A new snapshot starts out empty, so stale responses are never served after the templates change
+        :param key: hashable key identifying the response, for example the endpoint and query parameters
+        :param build: function without arguments that builds the response body
+        :return: response body
+        """
+        body = self._responses.get(key, None)
+        if body is None:
+            body = build()
+            if len(self._responses) >= _max_responses:
+                # arbitrary query strings must not be able to grow this without bounds
+                self._responses.clear()
+            self._responses[key] = body
+
+        return body
+
+    def list_by_type(self, template_type):
+        """
+        :param template_type: bootstrap or init-cfg
+        :return: tuple of TemplateRecord of the given type in table order
+        """
+        return self._by_type.get(template_type, tuple())
+
+
+def _get_db_version():
+    """
+    Returns the modification time and the file change counter of the sqlite database file. Every commit from any
+    worker process changes these, so this is a cheap way to find out if our snapshot is stale without running a query.
+    The change counter is needed as well because file modification times are only updated every few milliseconds
+    :return: tuple of (modification time, change counter) or None if the database is not a local file
+    """
+    try:
+        with open(engine.url.database, 'rb') as db_file:
+            # the file change counter is a 4 byte big endian integer at offset 24 of the sqlite header
+            db_file.seek(24)
+            counter = db_file.read(4)
+            return os.fstat(db_file.fileno()).st_mtime_ns, counter
+    except (OSError, TypeError):
+        return None
+
+
+def load_snapshot():
+    """
+    Loads all templates from the database in a single query and atomically replaces the current snapshot
+    :return: the new TemplateSnapshot, or the previous one if the database could not be read
+    """
+    global _snapshot, _generation
+
+    # take the version first, any commit made while we are loading will cause another reload later on
+    version = _get_db_version()
+    try:
+        records = list()
+        texts = dict()
+        backfilled = False
+        for t in Template.query.order_by(Template.id):
+            if t.variables is None:
+                # this template was stored before we began to persist the variables
+                backfilled = True
+
+            records.append(TemplateRecord(name=t.name, description=t.description, type=t.type,
+                                          variables=frozenset(t.get_variables())))
+            texts[t.name] = t.template
+        if backfilled:
+            db_session.commit()
+            version = _get_db_version()
+
+    except SQLAlchemyError as sqe:
+        log.error('Could not load template snapshot: %s', sqe)
+        db_session.rollback()
+        if _snapshot is None:
+            # nothing to fall back on, hand out an empty snapshot but do not keep it so the next call tries again
+            return TemplateSnapshot(None, list(), dict())
+
+        return _snapshot
+
+    _generation += 1
+    _snapshot = TemplateSnapshot(version, records, texts)
+    log.info('Loaded template snapshot with %d templates', len(records))
+    return _snapshot
+
+
+def get_snapshot():
+    """
+    Returns the current template snapshot, reloading it first if any process has changed the database since it was
+    loaded
+    :return: TemplateSnapshot
+    """
+    snapshot = _snapshot
+    if snapshot is not None and (snapshot.version is None or snapshot.version == _get_db_version()):
+        return snapshot
+
+    with _reload_lock:
+        # another thread may have reloaded while we were waiting on the lock
+        if _snapshot is not snapshot and _snapshot.version == _get_db_version():
+            return _snapshot
+
+        return load_snapshot()
@@ -0,0 +1,251 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from . import archive_utils
+from . import metrics_utils
+
+_store_dir = '/tmp/bootstrapper/store'
+# number of seconds an archive is kept after it was last served
+_ttl = 3600
+# total size of all stored archives, the least recently served archives are removed first to stay below this
+_max_bytes = 1024 * 1024 * 1024
+# number of seconds between each sweep of the store and the build workspaces
+_sweep_interval = 60
+
+# keys and extensions may come from a job status file, so never allow anything that could escape the store directory
+_valid_key = re.compile(r'^[0-9a-f]+$')
+_valid_extensions = frozenset(('zip', 'iso'))
+
+_sweeper = None
+# set after each put so the sweeper can enforce the quota straight away
+_sweep_event = threading.Event()
+log = logging.getLogger(__name__)
+
+
+def init_store(store_config):
+    """
+    Configures the archive store from the 'archive_store' section of the configuration.yaml file and starts the
+    background sweeper
+    :param store_config: dict with the following optional keys: 'directory', 'ttl', 'max_bytes', 'sweep_interval'
+    :return: None
+    """
+    global _store_dir, _ttl, _max_bytes, _sweep_interval, _sweeper
+
+    _store_dir = store_config.get('directory', _store_dir)
+    _ttl = store_config.get('ttl', _ttl)
+    _max_bytes = store_config.get('max_bytes', _max_bytes)
+    _sweep_interval = store_config.get('sweep_interval', _sweep_interval)
+
+    if _sweep_interval > 0 and _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep_forever, name='archive-store-sweeper', daemon=True)
+        _sweeper.start()
+
+
+def _get_store_path(key, extension):
+    """
+    :param key: content key of the archive, see archive_utils.get_content_key
+    :param extension: file extension of the archive, zip or iso
+    :return: path of the archive in the store or None if the key or extension is not valid
+    """
+    if not isinstance(key, str) or not _valid_key.match(key) or extension not in _valid_extensions:
+        return None
+
+    return os.path.join(_store_dir, '%s.%s' % (key, extension))
+
+
+def get(key, extension):
+    """
+    Retrieves a previously stored archive and marks it as recently served
+    :param key: content key of the archive
+    :param extension: file extension of the archive, zip or iso
+    :return: open file object of the stored archive or None if it has not been stored
+    """
+    store_path = _get_store_path(key, extension)
+    if store_path is None:
+        log.warning('Not a valid stored archive: %s.%s', key, extension)
+        metrics_utils.archive_store_requests.inc('miss')
+        return None
+
+    try:
+        # open before the sweeper has a chance to remove it, an open file can still be read after it is removed
+        archive = open(store_path, 'rb')
+        os.utime(store_path)
+    except OSError:
+        metrics_utils.archive_store_requests.inc('miss')
+        return None
+
+    metrics_utils.archive_store_requests.inc('hit')
+    log.debug('Found stored archive %s', store_path)
+    return archive
+
+
+def put(key, extension, archive):
+    """
+    Saves an archive into the store. The archive is written to a temporary file first and then moved into place, so
+    concurrent readers will never see a partially written archive
+    :param key: content key of the archive
+    :param extension: file extension of the archive, zip or iso
+    :param archive: file-like object or path to the archive as returned from the archive_utils functions. File-like
+    objects will be closed once they are stored
+    :return: open file object of the stored archive, or the given archive rewound to the start if it could not be
+    stored
+    """
+    with metrics_utils.stage_seconds.time('store_write'):
+        return _put(key, extension, archive)
+
+
+def _put(key, extension, archive):
+    store_path = _get_store_path(key, extension)
+    if store_path is None:
+        log.error('Could not store archive, not a valid key: %s.%s', key, extension)
+        if not isinstance(archive, str):
+            archive.seek(0)
+        return archive
+
+    tmp_path = '%s.%s.tmp' % (store_path, uuid.uuid4())
+    try:
+        if not os.path.exists(_store_dir):
+            os.makedirs(_store_dir)
+
+        if isinstance(archive, str):
+            shutil.copyfile(archive, tmp_path)
+        else:
+            with open(tmp_path, 'wb') as tmp_file:
+                shutil.copyfileobj(archive, tmp_file)
+
+        os.replace(tmp_path, store_path)
+        stored = open(store_path, 'rb')
+
+    except OSError as oe:
+        log.error('Could not store archive: %s', oe)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        # the archive can still be sent as is
+        if not isinstance(archive, str):
+            archive.seek(0)
+        return archive
+
+    if not isinstance(archive, str):
+        archive.close()
+
+    _sweep_event.set()
+    return stored
+
+
+def _list_store():
+    """
+    :return: list of (last served time, size, path) tuples of all archives in the store, oldest first
+    """
+    entries = list()
+    try:
+        for entry in os.scandir(_store_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        pass
+
+    return sorted(entries)
+
+
+def _get_tree_size(path):
+    """
+    :param path: file or directory
+    :return: total size in bytes of all files at or below path
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                continue
+
+    return total
+
+
+def sweep():
+    """
+    Removes stored archives that have not been served within the ttl, then removes the least recently served
+    archives until the store is below it's quota. Build workspaces older than the ttl, which can only be left behind
+    by a crashed build, are also removed
+    :return: number of bytes removed
+    """
+    removed = 0
+    expires = time.time() - _ttl
+
+    entries = _list_store()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if mtime > expires and total <= _max_bytes:
+            break
+
+        try:
+            os.remove(path)
+            removed += size
+            total -= size
+        except OSError:
+            continue
+
+    try:
+        leftovers = [e for e in os.scandir(archive_utils.get_workspace_dir()) if e.stat().st_mtime <= expires]
+    except OSError:
+        leftovers = list()
+
+    for entry in leftovers:
+        try:
+            size = _get_tree_size(entry.path)
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += size
+        except OSError:
+            continue
+
+    try:
+        # temporary files from an interrupted put
+        for entry in os.scandir(_store_dir):
+            if entry.name.endswith('.tmp') and entry.stat().st_mtime <= expires:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+    return removed
+
+
+def _sweep_forever():
+    while True:
+        _sweep_event.wait(_sweep_interval)
+        _sweep_event.clear()
+        try:
+            removed = sweep()
+            if removed:
+                log.info('Removed %d bytes of archives', removed)
+        except Exception as e:
+            # never let the sweeper die
+            log.error('Could not sweep archive store: %s', e)
+
+
+def get_usage():
+    """
+    Reports the current disk usage of the archive store and the build workspaces
+    :return: dict containing 'store_archives', 'store_bytes', 'max_bytes', 'ttl', and 'build_bytes' keys
+    """
+    entries = _list_store()
+    try:
+        build_bytes = _get_tree_size(archive_utils.get_workspace_dir())
+    except OSError:
+        build_bytes = 0
+
+    return dict(store_archives=len(entries), store_bytes=sum(size for mtime, size, path in entries),
+                max_bytes=_max_bytes, ttl=_ttl, build_bytes=build_bytes)
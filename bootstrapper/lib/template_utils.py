@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import jinja2
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import meta
+from jinja2 import TemplateSyntaxError
+
+from . import fs_utils
+from . import metrics_utils
+
+log = logging.getLogger(__name__)
+
+# maximum number of compiled templates to keep around before evicting the least recently used
+_max_entries = 128
+
+# compiled jinja Template objects keyed by (template_name, content_hash)
+_compiled_templates = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _content_hash(source):
+    """
+    Returns a stable hash of the template source text
+    :param source: string containing the template text
+    :return: hex digest of the template text
+    """
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class AtomicFileSystemBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja bytecode cache on the local disk that is shared by all worker processes. Bytecode is written to a temporary
+    file first and then moved into place, so a worker will never read a file another worker is still writing
+    """
+
+    def __init__(self, directory):
+        # bytecode is executed when loaded, so keep everyone else out of the directory
+        fs_utils.make_private_directory(directory)
+        super(AtomicFileSystemBytecodeCache, self).__init__(directory, '%s.jinja')
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        tmp_filename = '%s.%s.tmp' % (filename, uuid.uuid4())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                bucket.write_bytecode(f)
+
+            os.replace(tmp_filename, filename)
+
+        except OSError as oe:
+            log.error('Could not write bytecode cache: %s', oe)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+
+def init_bytecode_cache(directory):
+    """
+    Creates the bytecode cache from the 'bytecode_cache_directory' option of the configuration.yaml file. Assign the
+    result to the bytecode_cache of the flask jinja_env, this is used for both the file and the database templates
+    :param directory: directory to keep the compiled bytecode in, None or empty to disable the bytecode cache
+    :return: jinja BytecodeCache object or None
+    """
+    if not directory:
+        return None
+
+    try:
+        return AtomicFileSystemBytecodeCache(directory)
+    except OSError as oe:
+        log.error('Could not create bytecode cache directory: %s', oe)
+        return None
+
+
+def _compile(template_name, content_hash, source):
+    """
+    Compiles the template source, reusing the bytecode compiled by any other worker process if there is a bytecode
+    cache. This follows what jinja does for templates from a loader, which from_string does not do
+    :param template_name: name of the template as stored in the template table
+    :param content_hash: hash of the template source
+    :param source: string containing the template text
+    :return: compiled jinja2 Template object
+    """
+    env = current_app.jinja_env
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.from_string(source)
+
+    try:
+        # the content hash takes the place of the file name, so every version of a template gets it's own bucket. The
+        # prefix keeps out bytecode that earlier versions compiled with a different autoescape setting
+        bucket = bcc.get_bucket(env, template_name, 'from_string:%s' % content_hash, source)
+        code = bucket.code
+        if code is None:
+            # compiled without a name like from_string does, flask decides to autoescape by the name otherwise and
+            # the output would depend on the template name and on whether the bytecode cache is enabled
+            code = env.compile(source)
+            bucket.code = code
+            bcc.set_bucket(bucket)
+
+    except OSError as oe:
+        log.error('Could not use bytecode cache: %s', oe)
+        return env.from_string(source)
+
+    return env.template_class.from_code(env, code, env.make_globals(None), None)
+
+
+def find_variables(source):
+    """
+    Parse the template text and return all the undeclared variables used therein
+    :param source: string containing the template text
+    :return: set of variable names or an empty set if the template cannot be parsed
+    """
+    try:
+        # get a plain jinja environment to use it's parse function
+        env = jinja2.Environment()
+        # parse returns an AST that can be send to the meta module
+        ast = env.parse(source)
+        # return a set of all variable defined in the template
+        return meta.find_undeclared_variables(ast)
+
+    except TemplateSyntaxError as tse:
+        log.error('Could not parse template: %s', tse)
+        return set()
+
+
+def get_compiled_template(template_name, source):
+    """
+    Returns a compiled jinja2 Template object for the given template source. Compiled templates are cached
+    process wide keyed by the template name and a hash of the template contents, so a changed template will
+    never be served from a stale entry
+    :param template_name: name of the template as stored in the template table
+    :param source: string containing the template text
+    :return: compiled jinja2 Template object
+    """
+    content_hash = _content_hash(source)
+    key = (template_name, content_hash)
+
+    with _lock:
+        compiled = _compiled_templates.get(key, None)
+        if compiled is not None:
+            _compiled_templates.move_to_end(key)
+            _stats['hits'] += 1
+            return compiled
+
+        _stats['misses'] += 1
+
+    # compile outside of the lock, this is the expensive bit
+    with metrics_utils.stage_seconds.time('compile'):
+        compiled = _compile(template_name, content_hash, source)
+
+    with _lock:
+        _compiled_templates[key] = compiled
+        _compiled_templates.move_to_end(key)
+        while len(_compiled_templates) > _max_entries:
+            _compiled_templates.popitem(last=False)
+            _stats['evictions'] += 1
+
+    return compiled
+
+
+def render_template_string(template_name, source, **context):
+    """
+    Drop in replacement for flask.render_template_string that uses the compiled template cache
+    :param template_name: name of the template as stored in the template table
+    :param source: string containing the template text
+    :param context: variables to use when rendering the template
+    :return: rendered template as a string
+    """
+    compiled = get_compiled_template(template_name, source)
+    current_app.update_template_context(context)
+    return compiled.render(context)
+
+
+def invalidate(template_name):
+    """
+    Removes all compiled versions of the given template from the cache
+    :param template_name: name of the template to remove
+    :return: None
+    """
+    with _lock:
+        for key in [k for k in _compiled_templates if k[0] == template_name]:
+            del _compiled_templates[key]
+
+    log.info('Invalidated compiled template cache for %s', template_name)
+
+
+def clear():
+    """
+    Removes all entries from the compiled template cache and resets the counters
+    :return: None
+    """
+    with _lock:
+        _compiled_templates.clear()
+        for k in _stats:
+            _stats[k] = 0
+
+
+def get_stats():
+    """
+    Returns the current compiled template cache counters
+    :return: dict containing 'hits', 'misses', 'evictions', 'size', and 'max_size' keys
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats['size'] = len(_compiled_templates)
+
+    stats['max_size'] = _max_entries
+    return stats
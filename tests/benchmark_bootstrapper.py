@@ -0,0 +1,299 @@
+"""
+Offline benchmark of the generate_bootstrap_package pipeline. Each stage is timed on it's own against the library
+functions, plus the whole request through the flask test client, for the stock bootstrap.xml and synthetic templates
+of increasing size. Results are written to a JSON file so they can be compared between commits:
+
+    python -m tests.benchmark_bootstrapper --output before.json
+    git checkout my-branch
+    python -m tests.benchmark_bootstrapper --output after.json --baseline before.json
+
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bootstrapper import bootstrapper
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import bootstrapper_utils
+from bootstrapper.lib import cache_utils
+from bootstrapper.lib import store_utils
+from bootstrapper.lib import template_utils
+
+# template sizes to benchmark, 'stock' is the bootstrap.xml shipped with the bootstrapper
+default_sizes = ['stock', '256k', '1m', '4m']
+
+params = {
+    "hostname": "panos-bench",
+    "auth_key": "v123",
+    "management_ip": "192.168.1.100",
+    "management_netmask": "255.255.255.0",
+    "management_gateway": "192.168.1.254",
+    "dns_server": "192.168.1.2",
+    "outside_ip": "192.168.2.100",
+    "inside_ip": "192.168.3.100",
+    "ethernet1_1_profile": "PINGSSHTTPS",
+    "ethernet2_1_profile": "PINGSSHTTPS",
+    "default_next_hop": "10.10.10.10"
+}
+
+
+def _parse_size(size):
+    """
+    :param size: size such as 256k or 4m
+    :return: number of bytes
+    """
+    multipliers = {'k': 1024, 'm': 1024 * 1024}
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+
+    return int(size)
+
+
+def _get_stock_template():
+    path = os.path.join(os.path.dirname(bootstrapper.__file__), 'templates', 'panos', 'bootstrap.xml')
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def make_template(size):
+    """
+    Builds a synthetic bootstrap template of roughly the given size. The stock template is padded with address
+    objects that use the same variables, so every size needs the same parameters
+    :param size: 'stock' or a size such as 256k or 4m
+    :return: string containing the template text
+    """
+    stock = _get_stock_template()
+    if size == 'stock':
+        return stock
+
+    target = _parse_size(size)
+    entries = list()
+    total = len(stock)
+    i = 0
+    while total < target:
+        entry = '<entry name="bench-%d"><ip-netmask>{{ management_ip }}/32</ip-netmask>' \
+                '<description>{{ hostname }} address %d</description></entry>\n' % (i, i)
+        entries.append(entry)
+        total += len(entry)
+        i += 1
+
+    return stock.replace('</config>', '<!-- benchmark padding -->\n%s</config>' % ''.join(entries), 1)
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest rank percentile
+    :param sorted_values: sorted list of numbers
+    :param percent: percentile to return, 0 - 100
+    :return: number
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def _get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def time_stage(stage, size, template_bytes, fn, iterations, max_seconds):
+    """
+    Runs fn repeatedly and collects the timings
+    :param stage: name of the stage
+    :param size: name of the template size
+    :param template_bytes: size of the template in bytes
+    :param fn: function taking the iteration number
+    :param iterations: maximum number of iterations
+    :param max_seconds: stop early once the stage has run this long, always runs at least once
+    :return: dict of results
+    """
+    # warm up first, one time costs such as compiling the template are measured by their own stages
+    fn(-1)
+
+    timings = list()
+    started = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - t)
+        if time.perf_counter() - started >= max_seconds:
+            break
+
+    total = sum(timings)
+    timings.sort()
+    result = dict(stage=stage, size=size, template_bytes=template_bytes, iterations=len(timings),
+                  ops_per_sec=len(timings) / total if total else None,
+                  mean_ms=total / len(timings) * 1000,
+                  p50_ms=_percentile(timings, 50) * 1000,
+                  p99_ms=_percentile(timings, 99) * 1000,
+                  min_ms=timings[0] * 1000,
+                  max_ms=timings[-1] * 1000,
+                  peak_rss_kb=_get_peak_rss_kb())
+    print('%-36s %6s %8d ops %10.1f ops/sec  p50 %9.3f ms  p99 %9.3f ms' % (
+        stage, size, result['iterations'], result['ops_per_sec'] or 0, result['p50_ms'], result['p99_ms']))
+    return result
+
+
+def benchmark_size(size, iterations, max_seconds):
+    """
+    Benchmarks every stage of the pipeline with a template of the given size
+    :param size: 'stock' or a size such as 256k or 4m
+    :param iterations: maximum number of iterations per stage
+    :param max_seconds: maximum number of seconds per stage
+    :return: list of result dicts
+    """
+    template = make_template(size)
+    template_name = 'BENCHMARK_%s' % size.upper()
+    template_bytes = len(template.encode('utf-8'))
+    bootstrapper_utils.delete_template(template_name)
+    bootstrapper_utils.import_template(template, template_name, 'Benchmark template', template_type='bootstrap')
+
+    bench_params = dict(params, bootstrap_template=template_name)
+    openstack_params = dict(bench_params, deployment_type='openstack')
+    results = list()
+
+    def stage(name, fn):
+        results.append(time_stage(name, size, template_bytes, fn, iterations, max_seconds))
+
+    try:
+        with bootstrapper.app.test_request_context():
+            def compile_template(i):
+                # an empty in process cache, like a freshly started worker. This measures loading the bytecode when
+                # the bytecode cache is enabled, and compiling the template from scratch otherwise
+                template_utils.clear()
+                template_utils.get_compiled_template(template_name, template)
+
+            stage('compile_template', compile_template)
+            stage('get_required_vars_from_template',
+                  lambda i: bootstrapper_utils.get_required_vars_from_template(template_name))
+            stage('build_base_configs', lambda i: bootstrapper_utils.build_base_configs(bench_params))
+
+            base_config = bootstrapper_utils.build_base_configs(bench_params)
+            stage('build_openstack_heat',
+                  lambda i: bootstrapper_utils.build_openstack_heat(dict(base_config), openstack_params,
+                                                                    archive=True))
+
+            contents = base_config['bootstrap.xml']['contents']
+            keys = list()
+            stage('cache_utils.set', lambda i: keys.append(cache_utils.set(contents)))
+            stage('cache_utils.get', lambda i: cache_utils.get(keys[i % len(keys)]))
+
+            def create_archive(i):
+                archive_utils.create_archive(base_config, 'panos-bench-%d' % i).close()
+
+            def create_iso(i):
+                archive_utils.create_iso(base_config, 'panos-bench-%d' % i).close()
+
+            stage('create_archive', create_archive)
+            stage('create_iso', create_iso)
+
+        client = bootstrapper.app.test_client()
+
+        def generate(i):
+            # a new hostname every time, so every request renders and builds a new archive
+            data = json.dumps(dict(bench_params, hostname='panos-bench-%d' % i))
+            r = client.post('/generate_bootstrap_package', data=data, content_type='application/json')
+            assert r.status_code == 200, r.status_code
+
+        stage('generate_bootstrap_package', generate)
+
+    finally:
+        bootstrapper_utils.delete_template(template_name)
+
+    return results
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Prints the change of the median time of each stage compared to a previous run
+    :param results: benchmark results dict
+    :param baseline: benchmark results dict of a previous run
+    :return: None
+    """
+    previous = dict(((r['stage'], r['size']), r) for r in baseline['results'])
+    print('\nchange of p50 compared to %s' % baseline.get('commit', 'baseline'))
+    for r in results['results']:
+        b = previous.get((r['stage'], r['size']), None)
+        if b is None or not b['p50_ms']:
+            continue
+
+        change = (r['p50_ms'] - b['p50_ms']) / b['p50_ms'] * 100
+        print('%-36s %6s %9.3f ms -> %9.3f ms %+7.1f%%' % (r['stage'], r['size'], b['p50_ms'], r['p50_ms'], change))
+
+
+def run(sizes=None, iterations=50, max_seconds=5.0):
+    """
+    Runs the whole benchmark. The cache and archive store are pointed at a temporary directory for the duration, so
+    nothing is left behind
+    :param sizes: list of template sizes, see make_template
+    :param iterations: maximum number of iterations per stage
+    :param max_seconds: maximum number of seconds per stage
+    :return: dict of results
+    """
+    if sizes is None:
+        sizes = default_sizes
+
+    work_dir = tempfile.mkdtemp(prefix='bootstrapper-bench-')
+    config = bootstrapper_utils.load_config()
+    try:
+        cache_config = dict(config.get('cache', dict()), directory=os.path.join(work_dir, 'cache'), sweep_interval=0)
+        cache_utils.init_cache(cache_config)
+        store_utils.init_store(dict(config.get('archive_store', dict()), directory=os.path.join(work_dir, 'store')))
+
+        results = list()
+        for size in sizes:
+            results.extend(benchmark_size(size, iterations, max_seconds))
+
+    finally:
+        cache_utils.init_cache(config.get('cache', dict()))
+        store_utils.init_store(config.get('archive_store', dict()))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return dict(commit=_get_git_commit(), timestamp=datetime.datetime.utcnow().isoformat() + 'Z',
+                python=platform.python_version(), platform=platform.platform(), iterations=iterations,
+                peak_rss_kb=_get_peak_rss_kb(), results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bootstrap package pipeline')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--sizes', default=','.join(default_sizes),
+                        help='comma separated template sizes, stock or a size such as 256k or 4m')
+    parser.add_argument('--iterations', type=int, default=50, help='maximum number of iterations per stage')
+    parser.add_argument('--max-seconds', type=float, default=5.0, help='maximum number of seconds per stage')
+    parser.add_argument('--baseline', default=None, help='JSON file of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    results = run(sizes=args.sizes.split(','), iterations=args.iterations, max_seconds=args.max_seconds)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('\npeak rss %d KB, results written to %s' % (results['peak_rss_kb'], args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
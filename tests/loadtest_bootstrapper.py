@@ -0,0 +1,268 @@
+"""
+Concurrent load generator for the bootstrapper service. Fires a weighted mix of requests at a running bootstrapper, or
+at one started in process on a free localhost port, and reports throughput, latency percentiles and error rates per
+endpoint:
+
+    python -m tests.loadtest_bootstrapper --concurrency 16 --duration 30 --mix zip=4,iso=1,openstack=1,get=2,set=2,list=2
+    python -m tests.loadtest_bootstrapper --url http://127.0.0.1:5002 --requests 1000 --hostnames 4
+
+A small number of --hostnames makes many concurrent requests build archives for the same hostname.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# all request types the load generator knows about and the default weight of each
+default_mix = {'zip': 4, 'iso': 1, 'openstack': 1, 'get': 2, 'set': 2, 'list': 2}
+
+params = {
+    "auth_key": "v123",
+    "management_ip": "192.168.1.100",
+    "management_netmask": "255.255.255.0",
+    "management_gateway": "192.168.1.254",
+    "dns_server": "192.168.1.2",
+    "outside_ip": "192.168.2.100",
+    "inside_ip": "192.168.3.100",
+    "ethernet1_1_profile": "PINGSSHTTPS",
+    "ethernet2_1_profile": "PINGSSHTTPS",
+    "default_next_hop": "10.10.10.10"
+}
+
+
+def parse_mix(mix):
+    """
+    :param mix: comma separated list of name=weight pairs such as zip=4,get=1
+    :return: dict of request type to weight
+    """
+    weights = dict()
+    for pair in mix.split(','):
+        name, weight = pair.split('=')
+        if name not in default_mix:
+            raise ValueError('Unknown request type %s, use one of %s' % (name, ', '.join(sorted(default_mix))))
+        weights[name] = float(weight)
+
+    return weights
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest rank percentile
+    :param sorted_values: sorted list of numbers
+    :param percent: percentile to return, 0 - 100
+    :return: number or None if there are no values
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+class LoadGenerator(object):
+    """
+    Sends requests from a number of threads until the duration has passed or the number of requests has been sent
+    """
+
+    def __init__(self, base_url, mix, concurrency=8, duration=None, total_requests=None, hostnames=100, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.mix = mix
+        self.concurrency = concurrency
+        self.duration = duration
+        self.total_requests = total_requests
+        self.hostnames = hostnames
+        self.timeout = timeout
+        # cache keys returned from /set, used by the get requests
+        self._keys = list()
+        self._lock = threading.Lock()
+        self._sent = 0
+        # request type -> list of (latency in seconds, boolean success)
+        self._samples = dict((name, list()) for name in mix)
+
+    def _request(self, path, payload=None):
+        """
+        :param path: path of the endpoint
+        :param payload: dict to post as json, or None to GET
+        :return: tuple of (status code, response body)
+        """
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        req = urllib.request.Request(self.base_url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as he:
+            return he.code, he.read()
+
+    def _generate(self, **extra):
+        payload = dict(params, hostname='panos-load-%d' % random.randrange(self.hostnames), **extra)
+        return self._request('/generate_bootstrap_package', payload)
+
+    def _set(self):
+        status, body = self._request('/set', dict(contents='load test %f' % random.random()))
+        if status == 200:
+            with self._lock:
+                self._keys.append(json.loads(body.decode('utf-8'))['key'])
+                # only keep the most recent keys around, older ones may have expired
+                del self._keys[:-1000]
+        return status, body
+
+    def _get(self):
+        with self._lock:
+            key = random.choice(self._keys) if self._keys else None
+
+        if key is None:
+            return self._set()
+
+        return self._request('/get/%s' % key)
+
+    def _send(self, name):
+        if name == 'zip':
+            return self._generate(archive_type='zip')
+        if name == 'iso':
+            return self._generate(archive_type='iso')
+        if name == 'openstack':
+            return self._generate(archive_type='zip', deployment_type='openstack')
+        if name == 'get':
+            return self._get()
+        if name == 'set':
+            return self._set()
+
+        return self._request('/list_templates')
+
+    def _next(self, deadline):
+        with self._lock:
+            if self.total_requests is not None and self._sent >= self.total_requests:
+                return False
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+
+            self._sent += 1
+            return True
+
+    def _worker(self, deadline):
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        while self._next(deadline):
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, body = self._send(name)
+                success = status < 400
+            except (OSError, ValueError):
+                success = False
+
+            latency = time.perf_counter() - started
+            with self._lock:
+                self._samples[name].append((latency, success))
+
+    def run(self):
+        """
+        Runs the load test
+        :return: dict of results
+        """
+        # make sure the get requests have something to fetch right away
+        if 'get' in self.mix:
+            self._set()
+
+        deadline = None if self.duration is None else time.perf_counter() + self.duration
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, args=(deadline,), daemon=True)
+                   for i in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return self._report(time.perf_counter() - started)
+
+    def _summarize(self, samples, elapsed):
+        latencies = sorted(s[0] for s in samples)
+        errors = sum(1 for s in samples if not s[1])
+
+        def ms(value):
+            return None if value is None else value * 1000
+
+        return dict(requests=len(samples), errors=errors,
+                    error_rate=errors / len(samples) if samples else 0.0,
+                    throughput=len(samples) / elapsed if elapsed else 0.0,
+                    p50_ms=ms(_percentile(latencies, 50)),
+                    p95_ms=ms(_percentile(latencies, 95)),
+                    p99_ms=ms(_percentile(latencies, 99)),
+                    max_ms=ms(latencies[-1] if latencies else None))
+
+    def _report(self, elapsed):
+        endpoints = dict((name, self._summarize(samples, elapsed)) for name, samples in self._samples.items())
+        all_samples = [s for samples in self._samples.values() for s in samples]
+        return dict(base_url=self.base_url, concurrency=self.concurrency, elapsed=elapsed, mix=self.mix,
+                    hostnames=self.hostnames, endpoints=endpoints, total=self._summarize(all_samples, elapsed))
+
+
+def start_server():
+    """
+    Starts the bootstrapper app in a background thread on a free localhost port
+    :return: tuple of (server, base url)
+    """
+    from werkzeug.serving import make_server
+    from bootstrapper import bootstrapper
+
+    server = make_server('127.0.0.1', 0, bootstrapper.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def print_report(results):
+    print('%-10s %9s %7s %8s %10s %10s %10s %10s' % ('endpoint', 'requests', 'errors', 'req/sec', 'p50 ms',
+                                                      'p95 ms', 'p99 ms', 'max ms'))
+    rows = sorted(results['endpoints'].items()) + [('total', results['total'])]
+    for name, r in rows:
+        if not r['requests']:
+            continue
+
+        print('%-10s %9d %6.1f%% %8.1f %10.2f %10.2f %10.2f %10.2f' % (
+            name, r['requests'], r['error_rate'] * 100, r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['max_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent load test of the bootstrapper service')
+    parser.add_argument('--url', default=None, help='base url of a running bootstrapper, starts one in process if '
+                                                    'not given')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=None, help='number of seconds to run for')
+    parser.add_argument('--requests', type=int, default=None, help='total number of requests to send')
+    parser.add_argument('--mix', default=','.join('%s=%d' % i for i in sorted(default_mix.items())),
+                        help='comma separated request types and weights, from %s' % ', '.join(sorted(default_mix)))
+    parser.add_argument('--hostnames', type=int, default=100,
+                        help='number of distinct hostnames to generate packages for')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    if args.duration is None and args.requests is None:
+        args.duration = 10.0
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server, base_url = start_server()
+
+    try:
+        generator = LoadGenerator(base_url, parse_mix(args.mix), concurrency=args.concurrency,
+                                  duration=args.duration, total_requests=args.requests, hostnames=args.hostnames)
+        results = generator.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print_report(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,34 @@
+import io
+import logging
+import logging.handlers
+import os
+import pstats
+import shutil
+import threading
+import zipfile
+
 import pytest
+import sqlalchemy
 from flask import json
 import time
 
 from bootstrapper import bootstrapper
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import bootstrapper_utils
+from bootstrapper.lib import cache_utils
+from bootstrapper.lib import coalesce_utils
+from bootstrapper.lib import config_utils
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import log_utils
+from bootstrapper.lib import profile_utils
+from bootstrapper.lib import repository_utils
+from bootstrapper.lib import store_utils
+from bootstrapper.lib import template_utils
+from bootstrapper.lib.db import db_session
+from bootstrapper.lib.db import engine
+from bootstrapper.lib.db_models import Template
+from tests import benchmark_bootstrapper
+from tests import loadtest_bootstrapper
 
 
 @pytest.fixture
@@ -45,6 +71,32 @@ def test_caching(client):
     assert b'HI THERE' in d
 
 
+def test_cache_backends(tmpdir):
+    """
+    Tests the sharded file cache expires entries and the memory tier stays within it's byte budget
+    :param tmpdir: temporary directory to hold the cache
+    :return: test assertions
+    """
+    print("Test: Cache Backends".center(79, '-'))
+
+    file_cache = cache_utils.ShardedFileCache(cache_dir=str(tmpdir), sweep_interval=0)
+    assert file_cache.set('abcdef', 'HI THERE')
+    assert file_cache.set('abcxyz', 'GONE', timeout=-1)
+    assert file_cache.get('abcdef') == 'HI THERE'
+    assert file_cache.get('abcxyz') is None
+    assert file_cache.get('../abcdef') is None
+    assert file_cache.sweep() == 1
+
+    memory_cache = cache_utils.MemoryCache(max_bytes=1024, backing_cache=file_cache)
+    for i in range(10):
+        assert memory_cache.set('key%d' % i, 'x' * 200)
+
+    assert memory_cache._bytes <= 1024
+    assert 'key0' not in memory_cache._entries
+    # evicted from the memory tier but still found in the file cache
+    assert memory_cache.get('key0') == 'x' * 200
+
+
 # def test_build_openstack_bootstrap(client):
 #     """
 #     Tests build_bootstrap with deploy option set to openstack
@@ -159,6 +211,919 @@ def test_build_openstack_archive(client):
     assert r.status_code == 200
 
 
+def test_build_openstack_heat_urls(client):
+    """
+    Tests rendered files are only stored in the cache once a url is needed to retrieve them
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Build Openstack Heat Urls".center(79, '-'))
+
+    params = {
+        "deployment_type": "openstack",
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2",
+        "outside_ip": "192.168.2.100",
+        "inside_ip": "192.168.3.100"
+    }
+    with bootstrapper.app.test_request_context():
+        base_config = bootstrapper_utils.build_base_configs(params)
+        assert all('key' not in f for f in base_config.values())
+
+        base_config = bootstrapper_utils.build_openstack_heat(base_config, params, archive=False)
+
+    assert 'key' not in base_config['heat-template.yaml']
+    key = base_config['init-cfg.txt']['key']
+    assert base_config['init-cfg.txt']['url'].endswith('/get/%s' % key)
+    r = client.get('/get/%s' % key)
+    assert r.status_code == 200
+    assert b'hostname=panos-81' in r.data
+
+
+def test_config_reload(client, tmpdir):
+    """
+    Tests configuration files are only parsed again when they change and are handed out read only
+    :param client: test client
+    :param tmpdir: temporary directory for the configuration file
+    :return: test assertions
+    """
+    print("Test: Config Reload".center(79, '-'))
+
+    path = str(tmpdir.join('test.yaml'))
+    with open(path, 'w') as f:
+        f.write('base_url: http://one\nlocations:\n  - a\n')
+
+    config_file = config_utils.ConfigFile(path)
+    config = config_file.get()
+    assert config['base_url'] == 'http://one'
+    assert config_file.get() is config
+
+    with pytest.raises(TypeError):
+        config['base_url'] = 'http://changed'
+    assert config['locations'] == ('a',)
+
+    with open(path, 'w') as f:
+        f.write('base_url: http://two\n')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert config_file.get()['base_url'] == 'http://two'
+
+    # a broken file keeps the last good copy around
+    with open(path, 'w') as f:
+        f.write('base_url: [http://three\n')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 2 * 10 ** 9))
+    assert config_file.get()['base_url'] == 'http://two'
+
+    r = client.post('/reload_config')
+    assert r.status_code == 200
+    assert bootstrapper_utils.load_config() is bootstrapper_utils.load_config()
+
+
+def test_template_cache_stats(client):
+    """
+    Tests the compiled template cache is used when the same templates are rendered more than once
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Template Cache Stats".center(79, '-'))
+
+    params = {
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    for i in range(2):
+        r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+        assert r.status_code == 200
+
+    r = client.get('/template_cache_stats')
+    assert r.status_code == 200
+    d = json.loads(r.data)
+    assert d['success'] is True
+    assert d['stats']['hits'] >= 1
+    assert d['stats']['size'] >= 1
+
+
+def test_metrics(client):
+    """
+    Tests the pipeline metrics are exposed in the prometheus text format
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Metrics".center(79, '-'))
+
+    params = {
+        # a new hostname every run, so the archive is built instead of served from the archive store
+        "hostname": "panos-metrics-%d" % time.time(),
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.content_type.startswith('text/plain; version=0.0.4')
+    text = r.data.decode('utf-8')
+    assert '# TYPE bootstrapper_stage_duration_seconds histogram' in text
+    assert 'bootstrapper_stage_duration_seconds_bucket{stage="render_init_cfg",le="+Inf"}' in text
+    assert 'bootstrapper_stage_duration_seconds_count{stage="zip"}' in text
+    assert 'bootstrapper_archives_total{type="zip",mode="memory"}' in text
+    assert 'bootstrapper_builds_in_flight{type="zip"} 0.0' in text
+    assert 'bootstrapper_archive_store_bytes{area="store"}' in text
+    assert 'bootstrapper_jobs{state="queued"}' in text
+
+
+def test_profile_request(client, monkeypatch, tmpdir):
+    """
+    Tests a request is only profiled when profiling is enabled, the token matches, and the rate limit allows it
+    :param client: test client
+    :param monkeypatch: used to enable profiling
+    :param tmpdir: profile directory
+    :return: test assertions
+    """
+    print("Test: Profile Request".center(79, '-'))
+
+    profile_dir = str(tmpdir.join('profiles'))
+    profile_config = dict(enabled=True, token='secret', directory=profile_dir, max_profiles=2, min_interval=0)
+    config = dict(bootstrapper_utils.load_config(), profiling=profile_config)
+    monkeypatch.setattr(bootstrapper_utils, 'load_config', lambda: config)
+
+    r = client.get('/list_templates', headers={profile_utils.request_header: 'wrong'})
+    assert profile_utils.response_header not in r.headers
+
+    profile_ids = list()
+    for i in range(3):
+        r = client.get('/list_templates?profile=secret')
+        assert r.status_code == 200
+        profile_ids.append(r.headers[profile_utils.response_header])
+
+    # only the newest profiles are kept, and they can be loaded with pstats
+    assert sorted(os.listdir(profile_dir)) == ['%s.prof' % p for p in profile_ids[1:]]
+    pstats.Stats(os.path.join(profile_dir, '%s.prof' % profile_ids[-1]))
+
+    profile_config['min_interval'] = 3600
+    r = client.get('/list_templates', headers={profile_utils.request_header: 'secret'})
+    assert r.status_code == 200
+    assert profile_utils.response_header not in r.headers
+    assert profile_utils.get_stats()['active'] == 0
+
+
+def test_structured_logging(client):
+    """
+    Tests template bodies are only logged at DEBUG level and records are formatted as json with their fields
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Structured Logging".center(79, '-'))
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super(ListHandler, self).__init__()
+            self.records = list()
+
+        def emit(self, record):
+            self.records.append(record)
+
+    logger = logging.getLogger('bootstrapper')
+    assert any(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers)
+
+    params = {
+        "hostname": "panos-logging",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    handler = ListHandler()
+    level = logger.level
+    logger.addHandler(handler)
+    try:
+        r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+        assert r.status_code == 200
+        assert not [rec for rec in handler.records if hasattr(rec, 'template')]
+
+        logger.setLevel(logging.DEBUG)
+        r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+        assert r.status_code == 200
+        records = [rec for rec in handler.records if hasattr(rec, 'template')]
+        assert records
+
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    entry = json.loads(log_utils.JsonFormatter().format(records[0]))
+    assert entry['level'] == 'DEBUG'
+    assert entry['logger'] == 'bootstrapper.lib.bootstrapper_utils'
+    assert entry['message'] == 'Using init-cfg template init-cfg-static.txt'
+    assert 'hostname' in entry['template']
+
+
+def test_bytecode_cache(client, monkeypatch, tmpdir):
+    """
+    Tests compiled database templates are reused from the bytecode cache instead of being compiled again
+    :param client: test client
+    :param monkeypatch: used to swap out the bytecode cache
+    :param tmpdir: temporary bytecode cache directory
+    :return: test assertions
+    """
+    print("Test: Bytecode Cache".center(79, '-'))
+
+    env = bootstrapper.app.jinja_env
+    monkeypatch.setattr(env, 'bytecode_cache', template_utils.init_bytecode_cache(str(tmpdir.join('bytecode'))))
+
+    source = 'hostname={{ bytecode_hostname }}'
+    with bootstrapper.app.app_context():
+        template_utils.clear()
+        assert template_utils.render_template_string('TEST_BYTECODE', source, bytecode_hostname='a') == 'hostname=a'
+        assert len(tmpdir.join('bytecode').listdir()) == 1
+
+        # a fresh worker process has nothing compiled in memory, but must not need to compile the template again
+        template_utils.clear()
+        monkeypatch.setattr(env, 'compile', None)
+        assert template_utils.render_template_string('TEST_BYTECODE', source, bytecode_hostname='b') == 'hostname=b'
+
+
+def test_bytecode_cache_autoescape(client, monkeypatch, tmpdir):
+    """
+    Tests templates render the same with and without the bytecode cache, whatever their name
+    :param client: test client
+    :param monkeypatch: used to swap out the bytecode cache
+    :param tmpdir: temporary bytecode cache directory
+    :return: test assertions
+    """
+    print("Test: Bytecode Cache Autoescape".center(79, '-'))
+
+    env = bootstrapper.app.jinja_env
+    source = 'dns-primary={{ autoescape_value }}'
+    with bootstrapper.app.app_context():
+        for template_name in ('TEST_AUTOESCAPE.xml', 'TEST_AUTOESCAPE.txt', 'TEST_AUTOESCAPE'):
+            rendered = list()
+            for bytecode_cache in (None, template_utils.init_bytecode_cache(str(tmpdir.join('bytecode')))):
+                monkeypatch.setattr(env, 'bytecode_cache', bytecode_cache)
+                template_utils.clear()
+                rendered.append(template_utils.render_template_string(template_name, source,
+                                                                      autoescape_value='1.1.1.1&<x>'))
+
+            assert rendered == ['dns-primary=1.1.1.1&amp;&lt;x&gt;'] * 2
+
+
+def test_unsafe_bytecode_cache(tmpdir):
+    """
+    Tests the bytecode cache is disabled instead of loading bytecode from a directory other users can write to
+    :param tmpdir: temporary directory to create the bytecode cache directories in
+    :return: test assertions
+    """
+    print("Test: Unsafe Bytecode Cache".center(79, '-'))
+
+    private = tmpdir.mkdir('private')
+    private.chmod(0o755)
+    assert template_utils.init_bytecode_cache(str(private)) is not None
+    # a directory of our own is made private
+    assert private.stat().mode & 0o777 == 0o700
+
+    # a symlink may point anywhere
+    link = tmpdir.join('link')
+    link.mksymlinkto(private)
+    assert template_utils.init_bytecode_cache(str(link)) is None
+
+    # anyone can replace a directory in a world writable parent
+    shared = tmpdir.mkdir('shared')
+    shared.chmod(0o777)
+    assert template_utils.init_bytecode_cache(str(shared.join('bytecode'))) is None
+
+    if os.getuid() == 0:
+        # created first by another user
+        other = tmpdir.mkdir('other')
+        os.chown(str(other), 65534, 65534)
+        assert template_utils.init_bytecode_cache(str(other)) is None
+
+
+def test_unsafe_cache_directory(monkeypatch, tmpdir):
+    """
+    Tests the cache falls back to memory instead of unpickling entries from a directory other users can write to
+    :param monkeypatch: used to restore the configured cache afterwards
+    :param tmpdir: temporary directory to create the cache directories in
+    :return: test assertions
+    """
+    print("Test: Unsafe Cache Directory".center(79, '-'))
+    monkeypatch.setattr(cache_utils, '__cache', getattr(cache_utils, '__cache'))
+
+    private = tmpdir.mkdir('private')
+    private.chmod(0o755)
+    c = cache_utils.init_cache(dict(directory=str(private), sweep_interval=0))
+    assert isinstance(c._backing_cache, cache_utils.ShardedFileCache)
+    assert private.stat().mode & 0o777 == 0o700
+
+    link = tmpdir.join('link')
+    link.mksymlinkto(private)
+    c = cache_utils.init_cache(dict(directory=str(link), sweep_interval=0, memory_bytes=0))
+    assert isinstance(c, cache_utils.MemoryCache) and c._backing_cache is None
+
+    shared = tmpdir.mkdir('shared')
+    shared.chmod(0o777)
+    c = cache_utils.init_cache(dict(backend='werkzeug', directory=str(shared.join('cache'))))
+    assert isinstance(c, cache_utils.MemoryCache)
+    key = cache_utils.set('hostname=panos-01')
+    assert cache_utils.get(key) == 'hostname=panos-01'
+
+
+def test_in_memory_archive(client):
+    """
+    Tests the zip archive built in memory contains all the rendered files in the expected layout
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: In Memory Archive".center(79, '-'))
+
+    params = {
+        "deployment_type": "openstack",
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2",
+        "outside_ip": "192.168.2.100",
+        "inside_ip": "192.168.3.100"
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    names = zf.namelist()
+    assert 'config/init-cfg.txt' in names
+    assert 'license/authcodes' in names
+    assert 'heat-template.yaml' in names
+    assert b'hostname=panos-81' in zf.read('config/init-cfg.txt')
+
+
+def test_render_bootstrap_package(client, monkeypatch, tmpdir):
+    """
+    Tests the rendered files are returned as json without writing anything to the cache
+    :param client: test client
+    :param monkeypatch: used to swap out the cache
+    :param tmpdir: temporary cache directory
+    :return: test assertions
+    """
+    print("Test: Render Bootstrap Package".center(79, '-'))
+
+    params = {
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+
+    monkeypatch.setattr(cache_utils, '__cache', cache_utils.ShardedFileCache(cache_dir=str(tmpdir), sweep_interval=0))
+
+    r = client.post('/render_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    files = json.loads(r.data)['files']
+    assert 'hostname=panos-81' in files['init-cfg.txt']['contents']
+    assert files['init-cfg.txt']['archive_path'] == 'config'
+    assert 'v123' in files['authcodes']['contents']
+    assert 'key' not in files['init-cfg.txt']
+    assert tmpdir.listdir() == []
+
+    del params['hostname']
+    r = client.post('/render_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 400
+
+
+def test_generate_bootstrap_batch(client):
+    """
+    Tests building archives for several devices in one call. Invalid devices should be reported in the manifest
+    without failing the rest of the batch
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Generate Bootstrap Batch".center(79, '-'))
+
+    params = {
+        "auth_key": "v123",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2",
+        "devices": [
+            {"hostname": "panos-01", "management_ip": "192.168.1.101"},
+            {"hostname": "panos-02", "management_ip": "192.168.1.102"},
+            {"hostname": "panos-03"}
+        ]
+    }
+    r = client.post('/generate_bootstrap_batch', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    names = zf.namelist()
+    assert b'ip-address=192.168.1.101' in zf.read('panos-01/config/init-cfg.txt')
+    assert b'ip-address=192.168.1.102' in zf.read('panos-02/config/init-cfg.txt')
+    assert 'panos-03/config/init-cfg.txt' not in names
+
+    manifest = json.loads(zf.read('manifest.json'))
+    assert [d['success'] for d in manifest] == [True, True, False]
+
+    params['response_type'] = 'manifest'
+    r = client.post('/generate_bootstrap_batch', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    d = json.loads(r.data)
+    assert d['devices'][2]['success'] is False
+
+    r = client.get('/get/%s' % d['devices'][0]['key'])
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    assert b'hostname=panos-01' in zf.read('config/init-cfg.txt')
+
+
+def test_batch_matches_single_device(client, monkeypatch):
+    """
+    Tests the batch worker pool renders a device exactly like generate_bootstrap_package does
+    :param client: test client
+    :param monkeypatch: used to start a worker pool for this test
+    :return: test assertions
+    """
+    print("Test: Batch Matches Single Device".center(79, '-'))
+
+    # use the pool forked at boot, there is none on a single cpu so start one for this test
+    started = bootstrapper_utils._batch_pool is None
+    if started:
+        for name in ('_batch_app', '_batch_pool', '_batch_workers', '_batch_pool_pid'):
+            monkeypatch.setattr(bootstrapper_utils, name, getattr(bootstrapper_utils, name))
+        bootstrapper_utils.init_batch_pool(bootstrapper.app, 2)
+
+    params = {
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "1.1.1.1&<x>",
+        "bootstrap_template": "Default Bootstrap.xml"
+    }
+    try:
+        batch = dict(params, devices=[{"hostname": "panos-batch-a"}, {"hostname": "panos-batch-b"}])
+        r = client.post('/generate_bootstrap_batch', data=json.dumps(batch), content_type='application/json')
+        assert r.status_code == 200
+        batch_zip = zipfile.ZipFile(io.BytesIO(r.data))
+    finally:
+        if started:
+            bootstrapper_utils._batch_pool.terminate()
+
+    single = dict(params, hostname='panos-batch-a')
+    r = client.post('/generate_bootstrap_package', data=json.dumps(single), content_type='application/json')
+    assert r.status_code == 200
+    single_zip = zipfile.ZipFile(io.BytesIO(r.data))
+
+    names = [n for n in single_zip.namelist() if not n.endswith('/')]
+    assert b'dns-primary=1.1.1.1&amp;&lt;x&gt;' in single_zip.read('config/init-cfg.txt')
+    for name in names:
+        assert batch_zip.read('panos-batch-a/%s' % name) == single_zip.read(name)
+
+
+def test_batch_hostnames(client, monkeypatch, tmpdir):
+    """
+    Tests hostnames that are not plain directory names are rejected per device instead of being written outside of
+    their directory in the archive
+    :param client: test client
+    :param monkeypatch: used to build the archive on disk
+    :param tmpdir: directory an escaping hostname would be written to
+    :return: test assertions
+    """
+    print("Test: Batch Hostnames".center(79, '-'))
+
+    escaped = str(tmpdir.join('evil'))
+    params = {
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2",
+        "devices": [
+            {"hostname": "panos-ok"},
+            {"hostname": "../../../../../../../../.." + escaped},
+            {"hostname": ["panos-list"]},
+            {"hostname": ""},
+            {"hostname": ".."}
+        ]
+    }
+    config = dict(bootstrapper_utils.load_config())
+    for archive_mode in ('memory', 'filesystem'):
+        config['archive_mode'] = archive_mode
+        monkeypatch.setattr(bootstrapper_utils, 'load_config', lambda: config)
+        r = client.post('/generate_bootstrap_batch', data=json.dumps(params), content_type='application/json')
+        assert r.status_code == 200
+
+        zf = zipfile.ZipFile(io.BytesIO(r.data))
+        assert all(n.startswith('panos-ok/') or n == 'manifest.json' for n in zf.namelist() if not n.endswith('/'))
+        manifest = json.loads(zf.read('manifest.json'))
+        assert [d['success'] for d in manifest] == [True, False, False, False, False]
+        assert not os.path.exists(escaped)
+
+
+def test_archive_etag(client):
+    """
+    Tests identical requests return an identical archive with the same ETag, and a 304 when the client already has it
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Archive ETag".center(79, '-'))
+
+    params = {
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r1 = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    r2 = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r1.status_code == 200
+    assert r1.headers['ETag'] is not None
+    assert r1.headers['ETag'] == r2.headers['ETag']
+    assert r1.data == r2.data
+
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json',
+                    headers={'If-None-Match': r1.headers['ETag']})
+    assert r.status_code == 304
+    assert r.data == b''
+
+    params['management_ip'] = '192.168.1.101'
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json',
+                    headers={'If-None-Match': r1.headers['ETag']})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != r1.headers['ETag']
+
+
+def test_archive_store_quota(client, monkeypatch, tmpdir):
+    """
+    Tests the archive store removes the least recently served archives once over quota and reports it's usage
+    :param client: test client
+    :param monkeypatch: pytest monkeypatch fixture
+    :param tmpdir: temporary directory to hold the store
+    :return: test assertions
+    """
+    print("Test: Archive Store Quota".center(79, '-'))
+
+    monkeypatch.setattr(store_utils, '_store_dir', str(tmpdir))
+    monkeypatch.setattr(store_utils, '_max_bytes', 2048)
+    # keep the background sweeper out of the way, this test sweeps by itself
+    monkeypatch.setattr(store_utils, '_sweep_event', threading.Event())
+
+    # content keys are hex digests
+    first, second, third = 'a1', 'b2', 'c3'
+    for key in (first, second, third):
+        store_utils.put(key, 'zip', io.BytesIO(b'x' * 1000)).close()
+
+    # serving the first archive makes the second one the least recently served
+    later = time.time() + 10
+    os.utime(os.path.join(str(tmpdir), '%s.zip' % first), (later, later))
+    assert store_utils.sweep() >= 1000
+
+    assert store_utils.get(second, 'zip') is None
+    archive = store_utils.get(first, 'zip')
+    assert archive.read() == b'x' * 1000
+    archive.close()
+
+    r = client.get('/archive_store_stats')
+    d = json.loads(r.data)
+    assert d['success'] is True
+    assert d['stats']['store_archives'] == 2
+    assert d['stats']['store_bytes'] == 2000
+
+
+def test_bootstrap_job(client, monkeypatch):
+    """
+    Tests archives can be built asynchronously and the job queue pushes back when it is full
+    :param client: test client
+    :param monkeypatch: used to shrink the job queue
+    :return: test assertions
+    """
+    print("Test: Bootstrap Job".center(79, '-'))
+
+    params = {
+        "hostname": "panos-job",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r = client.post('/submit_bootstrap_job', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 202
+    d = json.loads(r.data)
+
+    r = client.get('%s?wait=10' % d['status_url'])
+    assert r.status_code == 200
+    assert json.loads(r.data)['job']['status'] == 'complete'
+
+    r = client.get(d['result_url'])
+    assert r.status_code == 200
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    assert b'hostname=panos-job' in zf.read('config/init-cfg.txt')
+
+    r = client.get('/job_status/not-a-job')
+    assert r.status_code == 404
+
+    monkeypatch.setattr(job_utils, '_max_queue', 0)
+    r = client.post('/submit_bootstrap_job', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] is not None
+
+    r = client.get('/job_stats')
+    stats = json.loads(r.data)['stats']
+    assert stats['rejected'] >= 1
+    assert stats['completed'] >= 1
+
+
+def test_bootstrap_job_other_worker(client, monkeypatch, tmpdir):
+    """
+    Tests a job can be followed and downloaded through a worker process other than the one it was submitted to
+    :param client: test client
+    :param monkeypatch: used to keep the job status in a temporary directory
+    :param tmpdir: temporary job directory
+    :return: test assertions
+    """
+    print("Test: Bootstrap Job Other Worker".center(79, '-'))
+
+    monkeypatch.setattr(job_utils, '_job_dir', str(tmpdir.join('jobs')))
+
+    def slow_job():
+        time.sleep(0.5)
+        return dict(built=True)
+
+    # the other worker only knows the job from it's status file
+    job = job_utils.submit(slow_job)
+    del job_utils._jobs[job.job_id]
+    other = job_utils.get(job.job_id)
+    assert other is not job
+    assert other.status in ('queued', 'running')
+    assert other.wait(10)
+    assert other.status == 'complete'
+    assert other.result == dict(built=True)
+
+    params = {
+        "hostname": "panos-job-other",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r = client.post('/submit_bootstrap_job', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 202
+    d = json.loads(r.data)
+    job_utils.get(d['job_id']).wait(10)
+    del job_utils._jobs[d['job_id']]
+
+    r = client.get('%s?wait=10' % d['status_url'])
+    assert r.status_code == 200
+    assert json.loads(r.data)['job']['status'] == 'complete'
+
+    r = client.get(d['result_url'])
+    assert r.status_code == 200
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    assert b'hostname=panos-job-other' in zf.read('config/init-cfg.txt')
+
+    assert job_utils.get('../../etc/passwd') is None
+
+    # a status file naming an archive outside of the store is not served
+    status_path = job_utils._get_status_path(d['job_id'])
+    with open(status_path) as f:
+        status = json.load(f)
+    status['result']['content_key'] = '../../../etc/passwd#'
+    with open(status_path, 'w') as f:
+        json.dump(status, f)
+    assert client.get(d['result_url']).status_code == 410
+    assert store_utils.get(status['result']['content_key'], 'zip') is None
+    assert store_utils.get('abc123', '../zip') is None
+
+    # status files are not read from a directory other users can write to
+    tmpdir.chmod(0o777)
+    assert job_utils.get(d['job_id']) is None
+
+
+def test_coalesced_requests(client, monkeypatch):
+    """
+    Tests identical concurrent requests only build the archive once and all get the same archive
+    :param client: test client
+    :param monkeypatch: used to count and slow down the builds
+    :return: test assertions
+    """
+    print("Test: Coalesced Requests".center(79, '-'))
+
+    builds = list()
+    build_base_configs = bootstrapper_utils.build_base_configs
+
+    def slow_build_base_configs(configuration_parameters, **kwargs):
+        builds.append(configuration_parameters['hostname'])
+        # give the other requests plenty of time to arrive while this one is in flight
+        time.sleep(0.5)
+        return build_base_configs(configuration_parameters, **kwargs)
+
+    monkeypatch.setattr(bootstrapper_utils, 'build_base_configs', slow_build_base_configs)
+
+    params = {
+        "hostname": "panos-coalesced",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    responses = list()
+
+    def generate(i):
+        # every thread gets it's own client, and every other thread posts the keys in a different order
+        c = bootstrapper.app.test_client()
+        data = json.dumps(dict(reversed(list(params.items()))) if i % 2 else params)
+        responses.append(c.post('/generate_bootstrap_package', data=data, content_type='application/json'))
+
+    coalesced = coalesce_utils.get_stats()['coalesced']
+    threads = [threading.Thread(target=generate, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert builds == ['panos-coalesced']
+    assert coalesce_utils.get_stats()['coalesced'] == coalesced + 4
+    assert all(r.status_code == 200 for r in responses)
+    assert len(set(r.data for r in responses)) == 1
+
+
+def test_benchmark(tmpdir):
+    """
+    Runs a single iteration of the benchmark suite to make sure it keeps working
+    :param tmpdir: temporary directory for the results
+    :return: test assertions
+    """
+    print("Test: Benchmark".center(79, '-'))
+
+    output = str(tmpdir.join('benchmark.json'))
+    benchmark_bootstrapper.main(['--output', output, '--sizes', 'stock,64k', '--iterations', '1'])
+    with open(output, 'r') as f:
+        results = json.load(f)
+
+    stages = set(r['stage'] for r in results['results'])
+    assert {'build_base_configs', 'create_archive', 'create_iso', 'generate_bootstrap_package'}.issubset(stages)
+    assert all(r['p99_ms'] >= r['p50_ms'] for r in results['results'])
+    assert results['peak_rss_kb'] > 0
+
+
+def test_load_generator(tmpdir):
+    """
+    Runs a short load test against an in process server to make sure the load generator keeps working
+    :param tmpdir: temporary directory for the results
+    :return: test assertions
+    """
+    print("Test: Load Generator".center(79, '-'))
+
+    output = str(tmpdir.join('loadtest.json'))
+    results = loadtest_bootstrapper.main(['--requests', '40', '--concurrency', '4', '--hostnames', '2',
+                                          '--output', output])
+    assert results['total']['requests'] == 40
+    assert results['total']['errors'] == 0
+    assert set(results['endpoints']) == set(loadtest_bootstrapper.default_mix)
+    with open(output, 'r') as f:
+        assert json.load(f)['total']['p99_ms'] >= results['total']['p50_ms']
+
+
+def test_streamed_archive(client, monkeypatch):
+    """
+    Tests the zip archives streamed to the client are complete and valid
+    :param client: test client
+    :param monkeypatch: used to switch the archive mode
+    :return: test assertions
+    """
+    print("Test: Streamed Archive".center(79, '-'))
+
+    config = dict(bootstrapper_utils.load_config(), archive_mode='stream')
+    monkeypatch.setattr(bootstrapper_utils, 'load_config', lambda: config)
+
+    params = {
+        "hostname": "panos-81",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert r.is_streamed
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    assert zf.testzip() is None
+    assert b'hostname=panos-81' in zf.read('config/init-cfg.txt')
+
+    params['devices'] = [{"hostname": "panos-01"}, {"hostname": "panos-02"}]
+    r = client.post('/generate_bootstrap_batch', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    zf = zipfile.ZipFile(io.BytesIO(r.data))
+    assert b'hostname=panos-02' in zf.read('panos-02/config/init-cfg.txt')
+    assert len(json.loads(zf.read('manifest.json'))) == 2
+
+
+def test_isolated_workspaces():
+    """
+    Tests archives built on disk for the same hostname never pick up files from another build and leave nothing behind
+    :return: test assertions
+    """
+    print("Test: Isolated Workspaces".center(79, '-'))
+
+    first = {
+        'init-cfg.txt': {'contents': 'FIRST', 'archive_path': 'config'},
+        'heat-template.yaml': {'contents': 'heat', 'archive_path': '.'}
+    }
+    second = {
+        'init-cfg.txt': {'contents': 'SECOND', 'archive_path': 'config'}
+    }
+    archive_utils.create_archive(first, 'panos-81', mode='filesystem').close()
+    archive = archive_utils.create_archive(second, 'panos-81', mode='filesystem')
+    zf = zipfile.ZipFile(archive)
+    assert 'heat-template.yaml' not in zf.namelist()
+    assert zf.read('config/init-cfg.txt') == b'SECOND'
+    archive.close()
+
+    assert os.listdir(archive_utils.get_workspace_dir()) == []
+
+
+def _list_iso_files(iso_fp):
+    """
+    Returns a sorted list of (path, contents) tuples of all files in the given ISO image using the Rock Ridge names
+    """
+    pycdlib = pytest.importorskip('pycdlib')
+    iso = pycdlib.PyCdlib()
+    iso.open_fp(iso_fp)
+    found = list()
+    for path, dirs, files in iso.walk(rr_path='/'):
+        for f in files:
+            rr_path = path.rstrip('/') + '/' + f
+            contents = io.BytesIO()
+            iso.get_file_from_iso_fp(contents, rr_path=rr_path)
+            found.append((rr_path, contents.getvalue()))
+
+    assert iso.pvd.volume_identifier.strip() == b'bootstrap'
+    return sorted(found)
+
+
+def test_in_memory_iso(client):
+    """
+    Tests the ISO image built in process contains all the rendered files in the expected layout
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: In Memory ISO".center(79, '-'))
+    pytest.importorskip('pycdlib')
+
+    params = {
+        "hostname": "panos-81",
+        "archive_type": "iso",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2"
+    }
+    r = client.post('/generate_bootstrap_package', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    files = dict(_list_iso_files(io.BytesIO(r.data)))
+    assert '/config/init-cfg.txt' in files
+    assert '/license/authcodes' in files
+    assert b'hostname=panos-81' in files['/config/init-cfg.txt']
+
+
+def test_iso_matches_mkisofs():
+    """
+    Tests the ISO image built in process holds the same files as the one built with mkisofs
+    :return: test assertions
+    """
+    print("Test: ISO Matches mkisofs".center(79, '-'))
+    if shutil.which('mkisofs') is None:
+        pytest.skip('mkisofs is not installed')
+
+    files = {
+        'init-cfg.txt': {'key': cache_utils.set('hostname=panos-81'), 'archive_path': 'config'},
+        'authcodes': {'key': cache_utils.set('v123'), 'archive_path': 'license'},
+        'heat-template.yaml': {'key': cache_utils.set('heat'), 'archive_path': '.'}
+    }
+    with archive_utils.create_iso(files, 'iso-compare', mode='memory') as native, \
+            archive_utils.create_iso(files, 'iso-compare', mode='mkisofs') as mkisofs:
+        assert _list_iso_files(native) == _list_iso_files(mkisofs)
+
+
 # def test_add_template_location(client):
 #     """
 #     Tests the api to add a template location to the configuration
@@ -206,6 +1171,142 @@ def test_get_bootstrap_variables(client):
     assert d['payload'] is not None
 
 
+def test_imported_template_variables(client):
+    """
+    Tests the variables of an imported template are parsed at import time and returned from the api
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Imported Template Variables".center(79, '-'))
+
+    params = {
+        "name": "TEST_VARIABLES",
+        "description": "ADDED BY PYTEST",
+        "template": "hostname={{ test_hostname }}"
+    }
+    r = client.post('/import_template', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+    params = {
+        "bootstrap_template": "TEST_VARIABLES"
+    }
+    r = client.post('/get_bootstrap_variables', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    d = json.loads(r.data)
+    assert 'test_hostname' in d['payload']
+
+    params = {
+        "template_name": "TEST_VARIABLES"
+    }
+    r = client.post('/delete_template', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+
+
+def test_bulk_import_templates(client, monkeypatch, tmpdir):
+    """
+    Tests all templates found in the import directory are imported at once and the service reports it is ready
+    :param client: test client
+    :param monkeypatch: used to point the import directory at tmpdir
+    :param tmpdir: temporary template import directory
+    :return: test assertions
+    """
+    print("Test: Bulk Import Templates".center(79, '-'))
+
+    r = client.get('/ready')
+    assert r.status_code == 200
+    assert json.loads(r.data)['ready']
+
+    for i in range(50):
+        tmpdir.join('bulk-%02d.xml' % i).write('<hostname>{{ bulk_%02d }}</hostname>' % i)
+
+    config = dict(bootstrapper_utils.load_config(), template_import_directory=str(tmpdir))
+    monkeypatch.setattr(bootstrapper_utils, 'load_config', lambda: config)
+
+    assert bootstrapper_utils.import_templates() == 50
+    # everything is already there the second time around
+    assert bootstrapper_utils.import_templates() == 0
+
+    assert bootstrapper_utils.get_required_vars_from_template('bulk-07.xml') == {'bulk_07'}
+    names = [t['name'] for t in bootstrapper_utils.list_bootstrap_templates()]
+    assert 'bulk-49.xml' in names
+
+    for i in range(50):
+        assert bootstrapper_utils.delete_template('bulk-%02d.xml' % i)
+
+
+def test_template_snapshot(client):
+    """
+    Tests the template snapshot is reloaded when another worker process changes the template table
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Template Snapshot".center(79, '-'))
+
+    r = client.get('/list_templates')
+    assert r.status_code == 200
+    snapshot = repository_utils.get_snapshot()
+    assert snapshot.get('Default Bootstrap.xml') is not None
+
+    # simulate another worker process by writing to the table behind the back of bootstrapper_utils
+    db_session.add(Template(name='TEST_SNAPSHOT', description='ADDED BY PYTEST', template='{{ test_snapshot }}'))
+    db_session.commit()
+    db_session.remove()
+
+    assert bootstrapper_utils.get_template('TEST_SNAPSHOT') == '{{ test_snapshot }}'
+    assert bootstrapper_utils.get_required_vars_from_template('TEST_SNAPSHOT') == {'test_snapshot'}
+    assert repository_utils.get_snapshot() is not snapshot
+
+    params = {
+        "template_name": "TEST_SNAPSHOT"
+    }
+    r = client.post('/delete_template', data=json.dumps(params), content_type='application/json')
+    assert r.status_code == 200
+    assert bootstrapper_utils.get_template('TEST_SNAPSHOT') is None
+
+
+def test_snapshot_request_path(client, monkeypatch):
+    """
+    Tests building a package right after the snapshot was reloaded reads the snapshot once and never queries the
+    database
+    :param client: test client
+    :param monkeypatch: used to count the snapshot lookups
+    :return: test assertions
+    """
+    print("Test: Snapshot Request Path".center(79, '-'))
+
+    params = {
+        "hostname": "panos-snapshot",
+        "auth_key": "v123",
+        "management_ip": "192.168.1.100",
+        "management_netmask": "255.255.255.0",
+        "management_gateway": "192.168.1.254",
+        "dns_server": "192.168.1.2",
+        "bootstrap_template": "Default Bootstrap.xml"
+    }
+    repository_utils.load_snapshot()
+    db_session.remove()
+
+    lookups = list()
+    get_snapshot = repository_utils.get_snapshot
+    monkeypatch.setattr(repository_utils, 'get_snapshot', lambda: lookups.append(1) or get_snapshot())
+
+    statements = list()
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        with bootstrapper.app.test_request_context():
+            base_config = bootstrapper_utils.build_base_configs(params)
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statement)
+
+    assert 'bootstrap.xml' in base_config
+    assert statements == []
+    assert len(lookups) == 1
+
+
 def test_import_template(client):
     """
     Tests the api to import template files
@@ -268,6 +1369,80 @@ def test_list_templates(client):
     assert found_import is True
 
 
+def test_list_templates_paging(client):
+    """
+    Tests the template lists can be filtered by type and name prefix and paged through
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: List Templates Paging".center(79, '-'))
+
+    for i in range(5):
+        assert bootstrapper_utils.import_template('{{ page_%d }}' % i, 'TEST_PAGE_%d' % i, 'ADDED BY PYTEST')
+
+    try:
+        r = client.get('/list_templates?name_prefix=TEST_PAGE_&offset=2&limit=2')
+        assert r.status_code == 200
+        d = json.loads(r.data)
+        assert d['total'] == 5
+        assert [t['name'] for t in d['templates']] == ['TEST_PAGE_2', 'TEST_PAGE_3']
+
+        r = client.get('/list_templates?type=init-cfg')
+        d = json.loads(r.data)
+        assert d['total'] == len(d['templates'])
+        assert all(t['type'] == 'init-cfg' for t in d['templates'])
+
+        r = client.get('/list_init_cfg_templates?limit=1')
+        assert len(json.loads(r.data)['templates']) == 1
+
+        r = client.get('/list_templates?offset=-1')
+        assert r.status_code == 400
+
+        # the template text is only loaded when it is asked for
+        assert bootstrapper_utils.get_template('TEST_PAGE_4') == '{{ page_4 }}'
+
+    finally:
+        for i in range(5):
+            bootstrapper_utils.delete_template('TEST_PAGE_%d' % i)
+
+
+def test_template_conditional_get(client):
+    """
+    Tests the template endpoints answer 304 until the template library changes
+    :param client: test client
+    :return: test assertions
+    """
+    print("Test: Template Conditional Get".center(79, '-'))
+
+    r = client.get('/list_templates')
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    assert r.headers['Last-Modified'] is not None
+
+    r = client.get('/list_templates', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    r = client.post('/get_template', data=json.dumps({'template_name': 'Default Bootstrap.xml'}),
+                    content_type='application/json', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    r = client.get('/get_template?template_name=Default+Bootstrap.xml')
+    assert r.status_code == 200
+    assert b'hostname' in r.data
+
+    assert bootstrapper_utils.import_template('{{ conditional }}', 'TEST_CONDITIONAL', 'ADDED BY PYTEST')
+    try:
+        r = client.get('/list_templates', headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        assert 'TEST_CONDITIONAL' in [t['name'] for t in json.loads(r.data)['templates']]
+    finally:
+        bootstrapper_utils.delete_template('TEST_CONDITIONAL')
+
+    r = client.get('/bootstrapper.swagger.json')
+    assert r.status_code == 200
+    r = client.get('/bootstrapper.swagger.json', headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+
 def test_delete_template(client):
     """
     Tests the api to delete template files